@@ -1,22 +1,1454 @@
 import tkinter as tk
-from tkinter import ttk
+from tkinter import ttk, filedialog
+import os
+import json
+import base64
+import hashlib
+import itertools
+import argparse
+import asyncio
 import socket
+import tempfile
 import threading
 import struct
 import queue
-from cryptography.fernet import Fernet, InvalidToken
+import random
+import sqlite3
+import tracemalloc
+import zlib
+from collections import OrderedDict
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 import time
+try:
+    import resource
+except ImportError:
+    resource = None
 
 
-def main():
+#Wire format: 4-byte big-endian length, then the payload
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+READ_BUFFER_SIZE = 256 * 1024
+RECONNECT_DELAY_SEC = 0.5
+RECONNECT_MAX_DELAY_SEC = 10.0
+#Outgoing frames queued behind a write go out together in one write; a
+#flush delay holds the first frame back that long so a burst can join it
+FLUSH_DELAY_SEC = 0.0
+WRITE_BATCH_BYTES = 256 * 1024
+
+#Load test defaults (--load-test)
+LOAD_TEST_PEERS = 128
+LOAD_TEST_MESSAGES = 200
+LOAD_TEST_PAYLOAD = 140
+
+#Small-message send benchmark (--bench-send)
+SEND_BENCH_MESSAGES = 20000
+SEND_BENCH_BURST = 64
+SEND_BENCH_GAP_SEC = 0.002
+SEND_BENCH_PAYLOAD = 140
+
+#Receive benchmark (--bench-recv): (frame size, frames)
+RECV_BENCH_CASES = ((1024, 20000), (1024 * 1024, 200), (64 * 1024 * 1024, 3))
+
+#Packet inside a frame: version, type, flags, key id, sequence number, then
+#the raw AES-GCM body. Version 1 can't be mistaken for an older build's
+#Fernet text token, which always starts with "g".
+WIRE_VERSION = 1
+PACKET_HEADER = struct.Struct("!BBBxIQ")
+NONCE_SIZE = 12
+TAG_SIZE = 16
+MSG_TEXT, FILE_START, FILE_CHUNK, FILE_END, MSG_HELLO = 1, 2, 3, 4, 5
+FILE_KINDS = (FILE_START, FILE_CHUNK, FILE_END)
+PREVIEW_BYTES = 36
+
+#Compression before encryption. A hello packet on connect carries the codec
+#bits a peer can undo; a message is only compressed when every connected
+#peer announced zlib, and the same bit in its flags tells the receiver.
+FLAG_ZLIB = 0x01
+SUPPORTED_CODECS = FLAG_ZLIB
+COMPRESSION_LEVELS = {"off": None, "fast": 1, "zlib": 6}
+COMPRESS_MIN_BYTES = 256
+COMPRESS_SAMPLE_BYTES = 4096
+COMPRESS_MAX_RATIO = 0.9
+
+#File transfer: a file frame's body is the transfer id, then one sealed chunk
+TRANSFER_ID_SIZE = 16
+FILE_CHUNK_SIZE = 1024 * 1024
+RECEIVED_DIR = "received"
+#Received chunks waiting for the file writer thread: a peer's socket stops
+#being read above the high mark and starts again below the low one
+FILE_BACKLOG_HIGH_BYTES = 8 * FILE_CHUNK_SIZE
+FILE_BACKLOG_LOW_BYTES = 2 * FILE_CHUNK_SIZE
+FILE_BENCH_MB = 1024
+
+#History decrypt benchmark (--bench-decrypt)
+DECRYPT_BENCH_MESSAGES = 20000
+
+#History: sealed packets in SQLite, shown a screenful at a time
+HISTORY_DB = "history.db"
+HISTORY_ROWS = 12
+HISTORY_WHEEL_ROWS = 3
+PLAINTEXT_CACHE_ROWS = 1000
+HISTORY_SINCE = {"all": None, "1 h": 3600, "24 h": 86400}
+#Peer stored for messages and files sent to everyone, and how the view names it
+BROADCAST_PEER = "*"
+BROADCAST_LABEL = "broadcast"
+HISTORY_BENCH_MESSAGES = 100000
+
+#Incoming events: Tk is woken when something arrives, then applies at most
+#UI_BATCH_EVENTS per pass and lets the window repaint before the next pass
+UI_BATCH_EVENTS = 200
+UI_BATCH_GAP_MS = 1
+INBOX_BENCH_MESSAGES = 10000
+INBOX_BENCH_TRICKLE = 200
+INBOX_BENCH_POLL_MS = 150
+
+#Compression benchmark (--bench-compress)
+COMPRESS_BENCH_SEED = 23
+COMPRESS_BENCH_ROUNDS = 200
+
+#Wire format benchmark (--bench-wire): plaintext sizes
+WIRE_BENCH_SIZES = (32, 140, 1024, 16384)
+WIRE_BENCH_MESSAGES = 20000
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+class FrameReader:
+    # Incremental frame parser over one preallocated buffer. The socket reads
+    # straight into writable() (recv_into, or BufferedProtocol.get_buffer),
+    # feed() hands out every complete frame in it, and the unparsed tail is
+    # moved to the front. The buffer only grows for a frame bigger than itself
+    # and shrinks back once traffic is small again.
+    def __init__(self, max_frame=MAX_FRAME_SIZE, size=READ_BUFFER_SIZE):
+        self.max_frame = max_frame
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.needed = 0
+
+    def writable(self):
+        if self.needed > len(self.buffer):
+            self._move_tail(bytearray(self.needed))
+        elif self.end == len(self.buffer) or self.start + self.needed > len(self.buffer):
+            self._move_tail(self.buffer)
+        return self.view[self.end:]
+
+    def _move_tail(self, target):
+        # Overlapping memoryview copies are memmove()s, so compacting in place is safe
+        tail = self.end - self.start
+        target_view = memoryview(target)
+        target_view[:tail] = self.view[self.start:self.end]
+        self.buffer, self.view = target, target_view
+        self.start, self.end = 0, tail
+
+    def feed(self, nbytes):
+        self.end += nbytes
+        frames = []
+        largest = 0
+        while True:
+            available = self.end - self.start
+            if available < FRAME_HEADER.size:
+                self.needed = FRAME_HEADER.size
+                break
+            (length,) = FRAME_HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame:
+                raise FrameTooLarge(f"peer announced a {length}-byte frame (limit {self.max_frame})")
+            total = FRAME_HEADER.size + length
+            if available < total:
+                self.needed = total
+                break
+            frames.append(bytes(self.view[self.start + FRAME_HEADER.size:self.start + total]))
+            self.start += total
+            largest = max(largest, total)
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.size and largest <= self.size:
+                self.buffer = bytearray(self.size)
+                self.view = memoryview(self.buffer)
+        return frames
+
+
+class Peer(asyncio.BufferedProtocol):
+    # One connection. The event loop recv_into()s FrameReader's buffer, so
+    # there is no per-read allocation; outgoing frames wait in a queue that
+    # a writer task drains under the transport's flow control, so send()
+    # never blocks whoever calls it. Whatever is queued when the writer
+    # wakes up is written in one go.
+    def __init__(self, owner):
+        self.owner = owner
+        self.frames = FrameReader(owner.max_frame)
+        self.outbound = asyncio.Queue()
+        self.can_write = asyncio.Event()
+        self.can_write.set()
+        self.closed = asyncio.get_running_loop().create_future()
+        self.transport = None
+        self.name = None
+        self.writer_task = None
+        self.flushes = 0
+        self.codecs = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        sock = transport.get_extra_info("socket")
+        if sock is not None and sock.family in (socket.AF_INET, socket.AF_INET6):
+            #Batching happens in write_frames, so Nagle would only add delay
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        host, port = transport.get_extra_info("peername")[:2]
+        self.name = f"{host}:{port}"
+        self.writer_task = asyncio.ensure_future(self.write_frames())
+        self.write_frame(PACKET_HEADER.pack(WIRE_VERSION, MSG_HELLO, self.owner.codecs, 0, 0))
+        self.owner._peer_connected(self)
+
+    def get_buffer(self, sizehint):
+        return self.frames.writable()
+
+    def buffer_updated(self, nbytes):
+        try:
+            frames = self.frames.feed(nbytes)
+        except FrameTooLarge as e:
+            self.owner.on_status(f"Dropped {self.name}: {e}")
+            self.transport.abort()
+            return
+        for payload in frames:
+            if len(payload) == PACKET_HEADER.size and payload[0] == WIRE_VERSION and payload[1] == MSG_HELLO:
+                self.codecs = payload[2] & self.owner.codecs
+                self.owner._update_codecs()
+                continue
+            self.owner.on_frame(self, payload)
+
+    def pause_writing(self):
+        self.can_write.clear()
+
+    def resume_writing(self):
+        self.can_write.set()
+
+    def connection_lost(self, exc):
+        self.writer_task.cancel()
+        self.owner._peer_lost(self)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    async def write_frames(self):
+        # flush_delay None writes every frame on its own
+        delay = self.owner.flush_delay
+        while True:
+            payload = await self.outbound.get()
+            if delay and self.outbound.empty():
+                await asyncio.sleep(delay)
+            await self.can_write.wait()
+            parts = [FRAME_HEADER.pack(len(payload)), payload]
+            batched = len(payload)
+            while delay is not None and batched < WRITE_BATCH_BYTES and not self.outbound.empty():
+                payload = self.outbound.get_nowait()
+                parts += (FRAME_HEADER.pack(len(payload)), payload)
+                batched += len(payload)
+            self.flush(parts)
+
+    def write_frame(self, payload):
+        self.flush([FRAME_HEADER.pack(len(payload)), payload])
+
+    def flush(self, parts):
+        # One sendmsg() without joining on Python 3.12+; one joined send() before that
+        self.transport.writelines(parts)
+        self.flushes += 1
+
+    def close(self):
+        self.transport.close()
+
+
+class LanTransport:
+    # asyncio networking on its own thread next to Tk. It can listen and dial
+    # at the same time with any number of peers; links we dialled reconnect
+    # with backoff until disconnect(). on_frame(peer, payload), on_status(text)
+    # and on_lost(peer) are called on the loop thread.
+    def __init__(self, on_frame, on_status=None, max_frame=MAX_FRAME_SIZE, on_lost=None, flush_delay=FLUSH_DELAY_SEC,
+                 codecs=SUPPORTED_CODECS):
+        self.on_frame = on_frame
+        self.on_status = on_status or (lambda text: None)
+        self.on_lost = on_lost or (lambda peer: None)
+        self.max_frame = max_frame
+        self.flush_delay = flush_delay
+        self.codecs = codecs
+        #Codecs every connected peer can undo; read from other threads
+        self.shared_codecs = 0
+        self.loop = asyncio.new_event_loop()
+        self.peers = {}
+        self.servers = []
+        self.dialers = set()
+        self.pending = []
+        self.pending_lock = threading.Lock()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    #Thread-safe API (returns concurrent.futures.Future where there is a result)
+    def call(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def listen(self, host, port):
+        return self.call(self._listen(host, port))
+
+    def connect(self, host, port, reconnect=True):
+        return self.call(self._connect(host, port, reconnect))
+
+    def send(self, payload, peer=None):
+        # peer=None sends to everybody connected. Only the first send of a
+        # burst pays for waking the loop thread; the rest ride along.
+        with self.pending_lock:
+            self.pending.append((payload, peer))
+            if len(self.pending) > 1:
+                return
+        self.loop.call_soon_threadsafe(self._send_pending)
+
+    def send_file(self, key, path, peer=None):
+        return self.call(self._send_file(key, path, peer))
+
+    def disconnect(self):
+        return self.call(self._disconnect())
+
+    def peer_count(self):
+        return len(self.peers)
+
+    def set_reading(self, name, reading):
+        # Flow control for frame consumers that work off the loop thread
+        self.loop.call_soon_threadsafe(self._set_reading, name, reading)
+
+    def close(self):
+        # Doesn't wait: the caller is usually the Tk thread, and the loop may
+        # itself be waiting on Tk to take a status update
+        self.disconnect().add_done_callback(lambda _f: self.loop.call_soon_threadsafe(self.loop.stop))
+
+    #Loop-thread side
+    async def _listen(self, host, port):
+        server = await self.loop.create_server(lambda: Peer(self), host, port)
+        self.servers.append(server)
+        port = server.sockets[0].getsockname()[1]
+        self.on_status(f"Listening on {host}:{port}")
+        return port
+
+    def _set_reading(self, name, reading):
+        peer = self.peers.get(name)
+        if peer is None or peer.transport.is_closing():
+            return
+        if reading:
+            peer.transport.resume_reading()
+        else:
+            peer.transport.pause_reading()
+
+    def _peer_connected(self, peer):
+        self.peers[peer.name] = peer
+        self._update_codecs()
+        self.on_status(f"Connected to {peer.name} ({len(self.peers)} peers)")
+
+    def _peer_lost(self, peer):
+        self.peers.pop(peer.name, None)
+        self._update_codecs()
+        self.on_lost(peer)
+        self.on_status(f"Disconnected from {peer.name} ({len(self.peers)} peers)")
+
+    def _update_codecs(self):
+        shared = self.codecs if self.peers else 0
+        for peer in self.peers.values():
+            shared &= peer.codecs
+        self.shared_codecs = shared
+
+    async def _connect(self, host, port, reconnect):
+        # The first attempt fails loudly; after that the link is kept up in the background
+        _transport, peer = await self.loop.create_connection(lambda: Peer(self), host, port)
+        task = self.loop.create_task(self._keep_connected(host, port, peer, reconnect))
+        self.dialers.add(task)
+        task.add_done_callback(self.dialers.discard)
+
+    async def _keep_connected(self, host, port, peer, reconnect):
+        while True:
+            try:
+                await asyncio.shield(peer.closed)
+            except asyncio.CancelledError:
+                peer.close()
+                raise
+            if not reconnect:
+                return
+            delay = RECONNECT_DELAY_SEC
+            while True:
+                self.on_status(f"Lost {host}:{port}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                try:
+                    _transport, peer = await self.loop.create_connection(lambda: Peer(self), host, port)
+                    break
+                except OSError:
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY_SEC)
+
+    def _send_pending(self):
+        with self.pending_lock:
+            batch, self.pending = self.pending, []
+        for payload, peer in batch:
+            self._send(payload, peer)
+
+    def _send(self, payload, peer):
+        if peer is None:
+            targets = list(self.peers.values())
+        else:
+            targets = [self.peers[peer]] if peer in self.peers else []
+        for target in targets:
+            target.outbound.put_nowait(payload)
+
+    async def _send_file(self, key, path, peer):
+        # Chunks are written straight to the sockets, each one waiting until
+        # the transport drops below its high-water mark, so at most about one
+        # chunk per peer is in memory. Chat frames slot in between chunks.
+        targets = list(self.peers.values()) if peer is None else [self.peers[peer]]
+        if not targets:
+            raise ConnectionError("not connected")
+        for frame in file_frames(key, path):
+            for target in targets:
+                await target.can_write.wait()
+                if target.transport.is_closing():
+                    raise ConnectionError(f"{target.name} went away")
+                target.write_frame(frame)
+        return os.path.getsize(path)
+
+    async def _disconnect(self):
+        for task in list(self.dialers):
+            task.cancel()
+        for server in self.servers:
+            server.close()
+        self.servers = []
+        for peer in list(self.peers.values()):
+            peer.close()
+
+
+def derive_cipher(key, info, salt=None):
+    # AES-GCM keys are derived from the shared Fernet key, so users still
+    # only exchange that one key
+    secret = base64.urlsafe_b64decode(key)
+    if len(secret) != 32:
+        raise ValueError("not a Fernet key")
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=salt, info=info)
+    return AESGCM(hkdf.derive(secret))
+
+
+def transfer_cipher(key, transfer_id):
+    # Each transfer gets its own key, so the sequence number can be the nonce
+    return derive_cipher(key, b"lan file transfer", salt=transfer_id)
+
+
+def key_id(key):
+    # First 4 bytes of the key's SHA-256; tells the receiver which key to use
+    return int(KeyRing.fingerprint(key), 16)
+
+
+def seal_file_frame(cipher, kind, key_ref, transfer_id, seq, data):
+    # Header and transfer id are authenticated too, so chunks cannot be reordered, replayed or relabelled
+    header = PACKET_HEADER.pack(WIRE_VERSION, kind, 0, key_ref, seq) + transfer_id
+    return header + cipher.encrypt(seq.to_bytes(NONCE_SIZE, "big"), data, header)
+
+
+def file_frames(key, path, chunk_size=FILE_CHUNK_SIZE):
+    # Lazily yields the frames for one file: start (name and size), one per
+    # chunk, then an end frame that seals the chunk count against truncation
+    transfer_id = os.urandom(TRANSFER_ID_SIZE)
+    cipher = transfer_cipher(key, transfer_id)
+    key_ref = key_id(key)
+    info = json.dumps({"name": os.path.basename(path), "size": os.path.getsize(path)}).encode()
+    yield seal_file_frame(cipher, FILE_START, key_ref, transfer_id, 0, info)
+    seq = 0
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            seq += 1
+            yield seal_file_frame(cipher, FILE_CHUNK, key_ref, transfer_id, seq, chunk)
+    yield seal_file_frame(cipher, FILE_END, key_ref, transfer_id, seq + 1, b"")
+
+
+def maybe_compress(data, level):
+    # (payload, compressed). Small payloads, and ones whose first few KB
+    # don't shrink at the fastest level, are left alone before paying for
+    # a full pass; the result is only kept if it saves at least 10%.
+    if level is None or len(data) < COMPRESS_MIN_BYTES:
+        return data, False
+    if len(data) > COMPRESS_SAMPLE_BYTES:
+        sample = data[:COMPRESS_SAMPLE_BYTES]
+        if len(zlib.compress(sample, 1)) > len(sample) * COMPRESS_MAX_RATIO:
+            return data, False
+    packed = zlib.compress(data, level)
+    if len(packed) > len(data) * COMPRESS_MAX_RATIO:
+        return data, False
+    return packed, True
+
+
+def inflate(data, limit=MAX_FRAME_SIZE):
+    # Bounded, so a small packet can't expand into gigabytes
+    inflater = zlib.decompressobj()
+    try:
+        out = inflater.decompress(data, limit)
+    except zlib.error:
+        raise InvalidToken
+    if inflater.unconsumed_tail or not inflater.eof:
+        raise InvalidToken
+    return out
+
+
+def packet_preview(packet, limit=PREVIEW_BYTES):
+    # base64 is only for showing ciphertext to a person, so only the shown part is encoded
+    if limit is None:
+        limit = len(packet)
+    text = base64.urlsafe_b64encode(bytes(packet[:limit])).decode()
+    return text + ("..." if len(packet) > limit else "")
+
+
+def peer_host(name):
+    # "host:port" -> host; a dialled peer's port changes with every connection
+    return name.rsplit(":", 1)[0]
+
+
+def unique_path(folder, name):
+    name = os.path.basename(name)
+    if name in ("", ".", ".."):
+        name = "received.bin"
+    base, ext = os.path.splitext(name)
+    path = os.path.join(folder, name)
+    n = 1
+    while os.path.exists(path) or os.path.exists(path + ".part"):
+        path = os.path.join(folder, f"{base} ({n}){ext}")
+        n += 1
+    return path
+
+
+class KeyRing:
+    # Parsed keys cached by fingerprint. The first key seals and every key
+    # opens: packets name their key, older Fernet tokens go through
+    # MultiFernet, so a rotated-out key still opens old messages.
+    # set_keys() swaps in new objects whole, so other threads can keep
+    # calling seal/open while the key box is being edited.
+    def __init__(self, keys=()):
+        self.cache = {}
+        self.keys = []
+        self.multi = None
+        self.by_id = {}
+        self.set_keys(keys)
+
+    @staticmethod
+    def fingerprint(key):
+        return hashlib.sha256(base64.urlsafe_b64decode(key)).hexdigest()[:8]
+
+    def set_keys(self, keys):
+        # Keys that do not parse are skipped; returns how many did
+        parsed = []
+        fernets = []
+        by_id = {}
+        for key in keys:
+            key = key.encode() if isinstance(key, str) else key
+            try:
+                fp = self.fingerprint(key)
+                if fp not in self.cache:
+                    self.cache[fp] = (Fernet(key), derive_cipher(key, b"lan chat"))
+            except ValueError:
+                continue
+            parsed.append(key)
+            fernets.append(self.cache[fp][0])
+            by_id.setdefault(int(fp, 16), (key, self.cache[fp][1]))
+        self.by_id = by_id
+        self.keys = parsed
+        self.multi = MultiFernet(fernets) if fernets else None
+        return len(parsed)
+
+    def fingerprints(self):
+        return [self.fingerprint(key) for key in self.keys]
+
+    def encrypt(self, data):
+        return self.multi.encrypt(data)
+
+    def decrypt(self, token):
+        multi = self.multi
+        if multi is None:
+            raise InvalidToken
+        return multi.decrypt(token)
+
+    def key_for(self, key_ref):
+        entry = self.by_id.get(key_ref)
+        return entry[0] if entry else None
+
+    def seal(self, data, seq, kind=MSG_TEXT, flags=0, level=None):
+        data, compressed = maybe_compress(data, level)
+        if compressed:
+            flags |= FLAG_ZLIB
+        by_id = self.by_id
+        key_ref = next(iter(by_id))
+        header = PACKET_HEADER.pack(WIRE_VERSION, kind, flags, key_ref, seq)
+        nonce = os.urandom(NONCE_SIZE)
+        return header + nonce + by_id[key_ref][1].encrypt(nonce, data, header)
+
+    def open(self, packet):
+        # (kind, flags, seq, plaintext); InvalidToken if no key opens it
+        if packet[:1] != bytes([WIRE_VERSION]):
+            return MSG_TEXT, 0, 0, self.decrypt(bytes(packet))
+        if len(packet) < PACKET_HEADER.size + NONCE_SIZE + TAG_SIZE:
+            raise InvalidToken
+        _version, kind, flags, key_ref, seq = PACKET_HEADER.unpack_from(packet)
+        #One read: set_keys may swap by_id from the Tk thread meanwhile
+        entry = self.by_id.get(key_ref)
+        if entry is None:
+            raise InvalidToken
+        cipher = entry[1]
+        body = memoryview(packet)[PACKET_HEADER.size:]
+        try:
+            data = cipher.decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:], packet[:PACKET_HEADER.size])
+        except InvalidTag:
+            raise InvalidToken
+        if flags & FLAG_ZLIB:
+            data = inflate(data)
+        return kind, flags, seq, data
+
+
+class MessageStore:
+    # Append-only SQLite log of sealed packets; plaintext never touches disk.
+    # Rows are read a page at a time, so reopening a long history costs a
+    # count and one page, not a full load. Use it from one thread.
+    def __init__(self, path=HISTORY_DB):
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY,
+                ts REAL NOT NULL,
+                direction TEXT NOT NULL,
+                peer TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                packet BLOB,
+                note TEXT
+            );
+            CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+            CREATE INDEX IF NOT EXISTS messages_direction ON messages (direction, ts);
+            CREATE INDEX IF NOT EXISTS messages_peer ON messages (peer, ts);
+        """)
+
+    def append(self, direction, peer, packet=None, note=None, kind="message", ts=None, commit=True):
+        # commit=False leaves the row in the open transaction for commit() to
+        # write out, so a burst of appends costs one commit instead of many
+        ts = time.time() if ts is None else ts
+        cursor = self.db.execute(
+            "INSERT INTO messages (ts, direction, peer, kind, packet, note) VALUES (?, ?, ?, ?, ?, ?)",
+            (ts, direction, peer, kind, packet, note))
+        if commit:
+            self.db.commit()
+        return cursor.lastrowid
+
+    def commit(self):
+        self.db.commit()
+
+    @staticmethod
+    def where(direction=None, peer=None, since=None):
+        clauses, args = [], []
+        if direction:
+            clauses.append("direction = ?")
+            args.append(direction)
+        if peer:
+            clauses.append("peer = ?")
+            args.append(peer)
+        if since is not None:
+            clauses.append("ts >= ?")
+            args.append(since)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), args
+
+    @staticmethod
+    def matches(filters, direction, peer, ts):
+        return ((not filters.get("direction") or filters["direction"] == direction)
+                and (not filters.get("peer") or filters["peer"] == peer)
+                and (filters.get("since") is None or ts >= filters["since"]))
+
+    def count(self, **filters):
+        where, args = self.where(**filters)
+        return self.db.execute("SELECT COUNT(*) FROM messages" + where, args).fetchone()[0]
+
+    def page(self, offset, limit, **filters):
+        # (id, ts, direction, peer, kind, first PREVIEW_BYTES of the packet, packet length, note)
+        where, args = self.where(**filters)
+        return self.db.execute(
+            "SELECT id, ts, direction, peer, kind, substr(packet, 1, ?), length(packet), note FROM messages"
+            + where + " ORDER BY ts, id LIMIT ? OFFSET ?", [PREVIEW_BYTES] + args + [limit, offset]).fetchall()
+
+    def packets(self, ids):
+        if not ids:
+            return []
+        marks = ",".join("?" * len(ids))
+        return self.db.execute(f"SELECT id, packet FROM messages WHERE id IN ({marks})", list(ids)).fetchall()
+
+    def get(self, msg_id):
+        return self.db.execute("SELECT id, ts, direction, peer, kind, packet, note FROM messages WHERE id = ?",
+                               (msg_id,)).fetchone()
+
+    def peers(self):
+        # Real peers only; broadcasts are filtered by BROADCAST_PEER
+        return [row[0] for row in self.db.execute(
+            "SELECT DISTINCT peer FROM messages WHERE peer != ? ORDER BY peer", (BROADCAST_PEER,))]
+
+    def close(self):
+        self.db.close()
+
+
+class UiInbox:
+    # Events from the network and decrypt threads waiting for the Tk thread.
+    # post() calls wake() only for the first event after a take(), so a flood
+    # costs one wake-up, and take() hands out at most limit events so applying
+    # them never holds the window for long.
+    def __init__(self, wake, limit=UI_BATCH_EVENTS):
+        self.wake = wake
+        self.limit = limit
+        self.events = []
+        self.lock = threading.Lock()
+        self.woken = False
+        self.closed = False
+
+    def post(self, *event):
+        with self.lock:
+            if self.closed:
+                return
+            self.events.append(event)
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.wake()
+        except (RuntimeError, tk.TclError):
+            #Window is gone or not up yet; the next post or take() tries again
+            with self.lock:
+                self.woken = False
+
+    def take(self):
+        # (batch, more); while more is true the caller should come back soon
+        with self.lock:
+            batch = self.events[:self.limit]
+            del self.events[:self.limit]
+            more = bool(self.events)
+            self.woken = more
+        return batch, more
+
+    def close(self):
+        # Shutting down: drop what is left, and later posts never wake Tk
+        with self.lock:
+            self.closed = True
+            self.events = []
+
+
+class FileReceiver:
+    # Decrypts file frames and writes each chunk on its own writer thread, so
+    # disk and crypto never hold up the loop thread and the other peers. One
+    # thread handles every transfer in arrival order. A peer with more than
+    # FILE_BACKLOG_HIGH_BYTES queued is paused through on_flow(peer, False)
+    # until the writer catches up, so TCP still pushes back on the sender.
+    # on_event is called with ("status", text) or ("file", "in", host, path, size).
+    def __init__(self, folder=RECEIVED_DIR, on_event=None, keyring=None, on_flow=None):
+        self.folder = folder
+        self.keyring = keyring or KeyRing()
+        self.on_event = on_event or (lambda *event: None)
+        self.on_flow = on_flow or (lambda peer, reading: None)
+        self.transfers = {}
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.backlog = {}
+        self.paused = set()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def handle(self, peer, payload):
+        # False for anything that is not a file frame; file frames are queued
+        if len(payload) < 2 or payload[0] != WIRE_VERSION or payload[1] not in FILE_KINDS:
+            return False
+        with self.lock:
+            queued = self.backlog.get(peer, 0) + len(payload)
+            self.backlog[peer] = queued
+            pause = queued > FILE_BACKLOG_HIGH_BYTES and peer not in self.paused
+            if pause:
+                self.paused.add(peer)
+        if pause:
+            self.on_flow(peer, False)
+        self.jobs.put((peer, payload))
+        return True
+
+    def drop_peer(self, peer):
+        # Queued behind the peer's remaining chunks
+        self.jobs.put((peer, None))
+
+    def _run(self):
+        while True:
+            peer, payload = self.jobs.get()
+            try:
+                if payload is None:
+                    self._drop_peer(peer)
+                else:
+                    self._handle(peer, payload)
+            except Exception as e:
+                #Keep the writer alive for the other transfers
+                self.on_event("status", f"File from {peer} failed: {e}")
+            finally:
+                if payload is not None:
+                    self._written(peer, len(payload))
+
+    def _written(self, peer, size):
+        # Peer names are host:port, so a reconnect can reuse one; never let
+        # the count go negative or missing
+        with self.lock:
+            queued = max(0, self.backlog.get(peer, 0) - size)
+            self.backlog[peer] = queued
+            resume = queued < FILE_BACKLOG_LOW_BYTES and peer in self.paused
+            if resume:
+                self.paused.discard(peer)
+        if resume:
+            self.on_flow(peer, True)
+
+    def _handle(self, peer, payload):
+        header_size = PACKET_HEADER.size + TRANSFER_ID_SIZE
+        if len(payload) < header_size:
+            return
+        _version, kind, _flags, key_ref, seq = PACKET_HEADER.unpack_from(payload)
+        header = payload[:header_size]
+        transfer_id = header[PACKET_HEADER.size:]
+        sealed = memoryview(payload)[header_size:]
+        if kind == FILE_START:
+            self.start(peer, key_ref, transfer_id, header, sealed)
+            return
+        transfer = self.transfers.get((peer, transfer_id))
+        if transfer is None:
+            return
+        try:
+            if seq != transfer["next"]:
+                raise InvalidTag()
+            data = transfer["cipher"].decrypt(seq.to_bytes(NONCE_SIZE, "big"), sealed, header)
+        except InvalidTag:
+            self.abort(peer, transfer_id, "corrupted")
+            return
+        transfer["next"] += 1
+        if kind == FILE_CHUNK:
+            try:
+                transfer["file"].write(data)
+            except OSError as e:
+                self.abort(peer, transfer_id, f"write failed ({e})")
+                return
+            transfer["received"] += len(data)
+        elif kind == FILE_END:
+            self.finish(peer, transfer_id)
+
+    def start(self, peer, key_ref, transfer_id, header, sealed):
+        if (peer, transfer_id) in self.transfers:
+            return
+        if not self.keyring.keys:
+            self.on_event("status", f"Ignored a file from {peer}: no key set")
+            return
+        key = self.keyring.key_for(key_ref)
+        try:
+            if key is None:
+                raise InvalidTag()
+            cipher = transfer_cipher(key, transfer_id)
+            info = json.loads(cipher.decrypt(bytes(NONCE_SIZE), sealed, header))
+        except (InvalidTag, ValueError):
+            self.on_event("status", f"Ignored a file from {peer}: wrong key")
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        path = unique_path(self.folder, info["name"])
+        self.transfers[(peer, transfer_id)] = {
+            "cipher": cipher, "path": path, "file": open(path + ".part", "wb"),
+            "size": info["size"], "received": 0, "next": 1, "started": time.perf_counter(),
+        }
+        self.on_event("status", f"Receiving {os.path.basename(path)} from {peer} ({info['size'] / 1e6:.1f} MB)")
+
+    def finish(self, peer, transfer_id):
+        transfer = self.transfers.pop((peer, transfer_id))
+        transfer["file"].close()
+        if transfer["received"] != transfer["size"]:
+            os.remove(transfer["path"] + ".part")
+            self.on_event("status", f"Discarded {os.path.basename(transfer['path'])}: size mismatch")
+            return
+        os.replace(transfer["path"] + ".part", transfer["path"])
+        elapsed = time.perf_counter() - transfer["started"]
+        self.on_event("status", f"Received {os.path.basename(transfer['path'])} "
+                                f"({transfer['size'] / 1e6:.1f} MB, {transfer['size'] / 1e6 / max(elapsed, 1e-9):.0f} MB/s)")
+        self.on_event("file", "in", peer_host(peer), transfer["path"], transfer["size"])
+
+    def abort(self, peer, transfer_id, reason):
+        transfer = self.transfers.pop((peer, transfer_id))
+        transfer["file"].close()
+        os.remove(transfer["path"] + ".part")
+        self.on_event("status", f"Dropped {os.path.basename(transfer['path'])} from {peer}: {reason}")
+
+    def _drop_peer(self, peer):
+        for owner, transfer_id in list(self.transfers):
+            if owner == peer:
+                self.abort(owner, transfer_id, "connection lost")
+        # The old connection's chunks were all written before this marker;
+        # anything still counted belongs to a reconnect under the same name
+        with self.lock:
+            if not self.backlog.get(peer) and peer not in self.paused:
+                self.backlog.pop(peer, None)
+
+
+def run_load_test(peers=LOAD_TEST_PEERS, messages=LOAD_TEST_MESSAGES, size=LOAD_TEST_PAYLOAD):
+    # Echo server on a LanTransport; every client connects first, then does
+    # messages round trips one at a time. Clients share this process (and the
+    # GIL) with the server, so the numbers are a floor.
+    server = LanTransport(on_frame=lambda peer, payload: peer.outbound.put_nowait(payload))
+    port = server.listen("127.0.0.1", 0).result()
+
+    async def client(ready, go, latencies):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        #The server's hello
+        await reader.readexactly(FRAME_HEADER.size + PACKET_HEADER.size)
+        payload = os.urandom(size)
+        frame = FRAME_HEADER.pack(size) + payload
+        ready.release()
+        await go.wait()
+        for _ in range(messages):
+            started = time.perf_counter()
+            writer.write(frame)
+            await writer.drain()
+            (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+        writer.close()
+        await writer.wait_closed()
+
+    async def run_clients():
+        ready = asyncio.Semaphore(0)
+        go = asyncio.Event()
+        latencies = []
+        tasks = [asyncio.create_task(client(ready, go, latencies)) for _ in range(peers)]
+        for _ in range(peers):
+            await ready.acquire()
+        # Wait until the server has registered every connection
+        while server.peer_count() < peers:
+            await asyncio.sleep(0.01)
+        connected = server.peer_count()
+        started = time.perf_counter()
+        go.set()
+        await asyncio.gather(*tasks)
+        return connected, latencies, time.perf_counter() - started
+
+    connected, latencies, elapsed = asyncio.run(run_clients())
+    server.close()
+    latencies.sort()
+
+    def percentile(q):
+        return 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    print(f"{connected} simultaneous peers, {messages} x {size}-byte round trips each")
+    print(f"{len(latencies) / elapsed:,.0f} messages/sec ({len(latencies)} in {elapsed:.2f}s)")
+    print(f"latency ms: p50 {percentile(0.50):.2f}  p95 {percentile(0.95):.2f}  p99 {percentile(0.99):.2f}  max {1000 * latencies[-1]:.2f}")
+
+
+def measure_sends(flush_delay, count, burst, gap):
+    # Message rate, latency percentiles (ms) and frames per write for count
+    # chat-sized messages sent in bursts of burst with gap seconds between
+    done = threading.Event()
+    latencies = []
+
+    def on_frame(peer, payload):
+        latencies.append(time.perf_counter() - struct.unpack_from("!d", payload)[0])
+        if len(latencies) == count:
+            done.set()
+
+    receiver = LanTransport(on_frame)
+    port = receiver.listen("127.0.0.1", 0).result()
+    sender = LanTransport(lambda peer, payload: None, flush_delay=flush_delay)
+    sender.connect("127.0.0.1", port, reconnect=False).result()
+    while receiver.peer_count() < 1:
+        time.sleep(0.01)
+    padding = bytes(SEND_BENCH_PAYLOAD - 8)
+    started = time.perf_counter()
+    for i in range(count):
+        sender.send(struct.pack("!d", time.perf_counter()) + padding)
+        if gap and (i + 1) % burst == 0:
+            time.sleep(gap)
+    done.wait(60)
+    elapsed = time.perf_counter() - started
+    flushes = sum(peer.flushes for peer in sender.peers.values())
+    sender.close()
+    receiver.close()
+    latencies.sort()
+
+    def percentile(q):
+        return 1000 * latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    return len(latencies) / elapsed, percentile(0.50), percentile(0.99), count / max(flushes, 1)
+
+
+def run_send_bench(count=SEND_BENCH_MESSAGES):
+    # Flood: every message queued as fast as the caller can. Bursts: groups
+    # of SEND_BENCH_BURST with a short pause, where latency matters.
+    modes = (("frame per write", None), ("coalesced", 0.0), ("coalesced, 1 ms budget", 0.001))
+    print(f"{'':<24} {'flood msg/s':>12} {'frames/write':>13}   {'burst p50 ms':>12} {'p99 ms':>7} {'frames/write':>13}")
+    for name, delay in modes:
+        rate, _p50, _p99, per_write = measure_sends(delay, count, count, 0)
+        _rate, p50, p99, burst_per_write = measure_sends(delay, count, SEND_BENCH_BURST, SEND_BENCH_GAP_SEC)
+        print(f"{name:<24} {rate:>12,.0f} {per_write:>13.1f}   {p50:>12.2f} {p99:>7.2f} {burst_per_write:>13.1f}")
+
+
+def legacy_recv_exact(sock, size):
+    # The original blocking reader: every chunk is concatenated onto the bytes so far
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("socket closed")
+        data += chunk
+    return data
+
+
+def legacy_recv_frame(sock):
+    (length,) = FRAME_HEADER.unpack(legacy_recv_exact(sock, FRAME_HEADER.size))
+    return legacy_recv_exact(sock, length)
+
+
+def send_bench_frames(port, payload, count):
+    header = FRAME_HEADER.pack(len(payload))
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        for _ in range(count):
+            sock.sendall(header)
+            sock.sendall(payload)
+
+
+def receive_legacy(listener, count):
+    conn, _ = listener.accept()
+    with conn:
+        for _ in range(count):
+            legacy_recv_frame(conn)
+
+
+async def receive_streams(listener, count):
+    # asyncio StreamReader.readexactly, the reader before FrameReader
+    done = asyncio.get_running_loop().create_future()
+
+    async def handle(reader, writer):
+        for _ in range(count):
+            (length,) = FRAME_HEADER.unpack(await reader.readexactly(FRAME_HEADER.size))
+            await reader.readexactly(length)
+        writer.close()
+        done.set_result(None)
+
+    server = await asyncio.start_server(handle, sock=listener)
+    await done
+    server.close()
+
+
+async def receive_buffered(listener, count, max_frame):
+    done = asyncio.get_running_loop().create_future()
+
+    class Counter(asyncio.BufferedProtocol):
+        def connection_made(self, transport):
+            self.transport = transport
+            self.frames = FrameReader(max_frame)
+            self.received = 0
+
+        def get_buffer(self, sizehint):
+            return self.frames.writable()
+
+        def buffer_updated(self, nbytes):
+            self.received += len(self.frames.feed(nbytes))
+            if self.received >= count:
+                self.transport.close()
+                done.set_result(None)
+
+    server = await asyncio.get_running_loop().create_server(Counter, sock=listener)
+    await done
+    server.close()
+
+
+def run_recv_bench(cases=RECV_BENCH_CASES):
+    # One sender thread per run pushes count frames of the given size over
+    # loopback; the clock stops when the receiver has parsed the last one.
+    receivers = {
+        "legacy recv": lambda listener, count, max_frame: receive_legacy(listener, count),
+        "readexactly": lambda listener, count, max_frame: asyncio.run(receive_streams(listener, count)),
+        "FrameReader": lambda listener, count, max_frame: asyncio.run(receive_buffered(listener, count, max_frame)),
+    }
+    print(f"{'frame':>8} {'frames':>7}  " + "  ".join(f"{name:>14}" for name in receivers))
+    for frame_size, count in cases:
+        payload = os.urandom(frame_size)
+        row = []
+        for name, receive in receivers.items():
+            listener = socket.create_server(("127.0.0.1", 0))
+            port = listener.getsockname()[1]
+            sender = threading.Thread(target=send_bench_frames, args=(port, payload, count))
+            started = time.perf_counter()
+            sender.start()
+            receive(listener, count, max(frame_size, MAX_FRAME_SIZE))
+            elapsed = time.perf_counter() - started
+            sender.join()
+            listener.close()
+            row.append(f"{frame_size * count / elapsed / 1e6:>10.1f} MB/s")
+        label = f"{frame_size // 1024} KB" if frame_size < 1024 * 1024 else f"{frame_size // (1024 * 1024)} MB"
+        print(f"{label:>8} {count:>7}  " + "  ".join(row))
+
+
+def peak_rss_mb():
+    if resource is None:
+        return float("nan")
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(FILE_CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def run_file_bench(megabytes=FILE_BENCH_MB):
+    # Sends a megabytes-sized file between two LanTransports over loopback
+    # and checks that what landed on disk hashes the same
+    key = Fernet.generate_key()
+    with tempfile.TemporaryDirectory() as folder:
+        source = os.path.join(folder, "payload.bin")
+        with open(source, "wb") as f:
+            for _ in range(megabytes):
+                f.write(os.urandom(1024 * 1024))
+        baseline = peak_rss_mb()
+        done = threading.Event()
+        received = []
+
+        def on_event(kind, *event):
+            if kind == "file":
+                received.append(event[2])
+                done.set()
+            elif kind == "status" and event[0].startswith(("Dropped", "Ignored", "Discarded")):
+                print(event[0])
+                done.set()
+
+        files = FileReceiver(os.path.join(folder, "received"), on_event, KeyRing([key]),
+                             on_flow=lambda peer, reading: server.set_reading(peer, reading))
+        server = LanTransport(on_frame=lambda peer, payload: files.handle(peer.name, payload),
+                              on_lost=lambda peer: files.drop_peer(peer.name))
+        port = server.listen("127.0.0.1", 0).result()
+        client = LanTransport(on_frame=lambda peer, payload: None)
+        client.connect("127.0.0.1", port, reconnect=False).result()
+        while server.peer_count() < 1:
+            time.sleep(0.01)
+        started = time.perf_counter()
+        client.send_file(key, source).result()
+        done.wait()
+        elapsed = time.perf_counter() - started
+        client.close()
+        server.close()
+        intact = bool(received) and file_sha256(received[0]) == file_sha256(source)
+        print(f"{megabytes} MB over loopback in {elapsed:.2f}s: {megabytes * 1024 * 1024 / 1e6 / elapsed:.0f} MB/s, "
+              f"{'intact' if intact else 'CORRUPTED'}")
+        print(f"peak RSS {peak_rss_mb():.0f} MB (before transfer {baseline:.0f} MB)")
+
+
+def run_decrypt_bench(count=DECRYPT_BENCH_MESSAGES):
+    # Decrypting a whole history of chat-sized tokens: the old per-click path
+    # (parse the key, build a Fernet, decrypt) against the cached KeyRing,
+    # including the post-rotation case where every token is under the old key
+    old_key, new_key = Fernet.generate_key(), Fernet.generate_key()
+    tokens = [Fernet(old_key).encrypt(os.urandom(105)) for _ in range(count)]
+    key_text = old_key.decode()
+
+    def per_message():
+        for token in tokens:
+            Fernet(key_text.strip().encode()).decrypt(token)
+
+    def cached(keyring):
+        def run():
+            for token in tokens:
+                keyring.decrypt(token)
+        return run
+
+    cases = [
+        ("new Fernet per message", per_message),
+        ("KeyRing, one key", cached(KeyRing([old_key]))),
+        ("KeyRing after rotation", cached(KeyRing([new_key, old_key]))),
+    ]
+    #Packets name their key, so rotation costs no failed attempts
+    rotated = KeyRing([new_key, old_key])
+    packets = [KeyRing([old_key]).seal(os.urandom(105), seq) for seq in range(count)]
+
+    def open_packets():
+        for packet in packets:
+            rotated.open(packet)
+
+    cases.append(("packets after rotation", open_packets))
+    for name, run in cases:
+        started = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - started
+        print(f"{name:<24} {count / elapsed:>10,.0f} msgs/sec")
+
+
+def compress_bench_payloads(seed=COMPRESS_BENCH_SEED):
+    # Deterministic stand-ins for what people actually paste
+    rng = random.Random(seed)
+    words = ("the server is up again after restart check logs please ok see you at five "
+             "bring charger deploy failed on build step retry cache clear done thanks").split()
+
+    def sentence(n):
+        return " ".join(rng.choice(words) for _ in range(n))
+
+    levels = ("DEBUG", "INFO", "INFO", "INFO", "WARNING", "ERROR")
+    log = "\n".join(
+        f"2026-10-18 12:{i // 60 % 60:02d}:{i % 60:02d},{rng.randrange(1000):03d} {rng.choice(levels):<7} "
+        f"worker-{rng.randrange(8)} request id={rng.getrandbits(32):08x} path=/api/v1/{rng.choice(words)} "
+        f"took {rng.randrange(1, 900)} ms"
+        for i in range(600)
+    )
+    records = [{"id": i, "user": rng.choice(words), "score": rng.randrange(10000), "tags": rng.sample(words, 3)}
+               for i in range(300)]
+    return [
+        ("chat line", sentence(12).encode()),
+        ("chat paragraph", sentence(110).encode()),
+        ("log paste", log.encode()),
+        ("JSON dump", json.dumps(records, indent=2).encode()),
+        ("random bytes", rng.randbytes(64 * 1024)),
+    ]
+
+
+def run_compress_bench(rounds=COMPRESS_BENCH_ROUNDS):
+    # Packet size relative to the plaintext, and seal/open throughput for
+    # each compression level; "off" is plain AES-GCM sealing
+    keyring = KeyRing([Fernet.generate_key()])
+    print(f"{'payload':<15} {'bytes':>7} {'level':>5} {'ratio':>6} {'seal MB/s':>10} {'open MB/s':>10}")
+    for name, data in compress_bench_payloads():
+        for level_name, level in COMPRESSION_LEVELS.items():
+            started = time.perf_counter()
+            for seq in range(rounds):
+                packet = keyring.seal(data, seq, level=level)
+            sealed = time.perf_counter() - started
+            started = time.perf_counter()
+            for _ in range(rounds):
+                keyring.open(packet)
+            opened = time.perf_counter() - started
+            megabytes = len(data) * rounds / 1e6
+            print(f"{name:<15} {len(data):>7} {level_name:>5} {len(packet) / len(data):>6.2f} "
+                  f"{megabytes / sealed:>10.0f} {megabytes / opened:>10.0f}")
+
+
+def run_history_bench(count=HISTORY_BENCH_MESSAGES):
+    # Fills a fresh store with count sealed chat packets, then times what a
+    # restart costs (open, count, last page) and page fetches anywhere in it.
+    # The old in-memory dict is built too, to compare what it kept in RAM.
+    keyring = KeyRing([Fernet.generate_key()])
+    packets = [keyring.seal(os.urandom(100), seq) for seq in range(1000)]
+    rng = random.Random(COMPRESS_BENCH_SEED)
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "history.db")
+        store = MessageStore(path)
+        base = time.time() - count
+        started = time.perf_counter()
+        for i in range(count):
+            store.append("in" if i % 2 else "out", f"10.0.0.{i % 7}", packets[i % len(packets)], ts=base + i)
+        append_rate = count / (time.perf_counter() - started)
+        store.close()
+
+        started = time.perf_counter()
+        store = MessageStore(path)
+        total = store.count()
+        store.page(max(0, total - HISTORY_ROWS), HISTORY_ROWS)
+        reopen_ms = 1000 * (time.perf_counter() - started)
+
+        timings = []
+        for _ in range(200):
+            started = time.perf_counter()
+            store.page(rng.randrange(total), HISTORY_ROWS)
+            timings.append(1000 * (time.perf_counter() - started))
+        timings.sort()
+        started = time.perf_counter()
+        filters = {"direction": "in", "peer": "10.0.0.3"}
+        matching = store.count(**filters)
+        store.page(matching // 2, HISTORY_ROWS, **filters)
+        filtered_ms = 1000 * (time.perf_counter() - started)
+        store.close()
+        size_mb = sum(os.path.getsize(os.path.join(folder, name)) for name in os.listdir(folder)) / 1e6
+
+    tracemalloc.start()
+    messages = {str(time.time_ns() + i): {"packet": keyring.seal(os.urandom(100), i), "plaintext": None}
+                for i in range(count)}
+    dict_mb = tracemalloc.get_traced_memory()[0] / 1e6
+    tracemalloc.stop()
+    del messages
+
+    print(f"{count:,} messages appended at {append_rate:,.0f}/s, {size_mb:.1f} MB on disk")
+    print(f"reopen (open + count + last page): {reopen_ms:.1f} ms")
+    print(f"random page: p50 {timings[len(timings) // 2]:.2f} ms  p99 {timings[int(0.99 * len(timings))]:.2f} ms")
+    print(f"filtered by direction and peer ({matching:,} rows): count + middle page {filtered_ms:.1f} ms")
+    print(f"old in-memory dict for the same history: {dict_mb:.1f} MB of Python objects")
+
+
+def run_inbox_bench(count=INBOX_BENCH_MESSAGES, trickle=INBOX_BENCH_TRICKLE):
+    # There is no window here, so a plain thread stands in for Tk and applies
+    # each message as a history append. "poll" is the old loop: wake every
+    # 150 ms, drain everything, commit per row. "inbox" is UiInbox with one
+    # commit per batch. Reports delivery latency for a trickle of single
+    # messages, and for a flood of count messages the longest stretch the UI
+    # thread spends applying without a chance to repaint.
+    keyring = KeyRing([Fernet.generate_key()])
+    packet = keyring.seal(os.urandom(100), 1)
+    rng = random.Random(COMPRESS_BENCH_SEED)
+
+    def run(mode, path, burst):
+        latencies, stalls = [], []
+        rounds = 1 if burst else trickle
+        total_messages = count if burst else trickle
+        done = threading.Event()
+        wake = threading.Event()
+        inbox = UiInbox(wake.set)
+        pending = queue.Queue()
+
+        def apply(store, events, commit):
+            started = time.perf_counter()
+            for (posted,) in events:
+                store.append("in", "10.0.0.1", packet, commit=commit)
+                latencies.append(time.perf_counter() - posted)
+            if not commit:
+                store.commit()
+            stalls.append(time.perf_counter() - started)
+
+        def consumer():
+            store = MessageStore(path)
+            while len(latencies) < total_messages:
+                if mode == "poll":
+                    time.sleep(INBOX_BENCH_POLL_MS / 1000)
+                    events = []
+                    while True:
+                        try:
+                            events.append(pending.get_nowait())
+                        except queue.Empty:
+                            break
+                    if events:
+                        apply(store, events, True)
+                    continue
+                wake.wait(0.05)
+                wake.clear()
+                while True:
+                    batch, more = inbox.take()
+                    if batch:
+                        apply(store, batch, False)
+                    if not more:
+                        break
+                    time.sleep(UI_BATCH_GAP_MS / 1000)
+            store.close()
+            done.set()
+
+        threading.Thread(target=consumer, daemon=True).start()
+        post = (lambda *event: pending.put(event)) if mode == "poll" else inbox.post
+        started = time.perf_counter()
+        for _ in range(rounds):
+            if burst:
+                for _ in range(count):
+                    post(time.perf_counter())
+            else:
+                time.sleep(rng.uniform(0, 0.02))
+                post(time.perf_counter())
+        done.wait()
+        elapsed = time.perf_counter() - started
+        latencies.sort()
+        return latencies, max(stalls), elapsed
+
+    print(f"{'mode':<6} {'load':<14} {'p50 ms':>8} {'p99 ms':>8} {'max stall ms':>13} {'all in ms':>10}")
+    with tempfile.TemporaryDirectory() as folder:
+        for mode in ("poll", "inbox"):
+            for burst in (False, True):
+                path = os.path.join(folder, f"{mode}-{burst}.db")
+                latencies, stall, elapsed = run(mode, path, burst)
+                load = f"flood {count:,}" if burst else f"trickle {trickle}"
+                print(f"{mode:<6} {load:<14} {1000 * latencies[len(latencies) // 2]:>8.1f} "
+                      f"{1000 * latencies[int(0.99 * len(latencies))]:>8.1f} {1000 * stall:>13.1f} "
+                      f"{1000 * elapsed:>10.0f}")
+
+
+def run_wire_bench(sizes=WIRE_BENCH_SIZES, count=WIRE_BENCH_MESSAGES):
+    # Frame bytes and CPU per message, sender and receiver together: the old
+    # text path (Fernet token -> str -> bytes, then back on receive) against
+    # sealed packets that stay bytes end to end
+    key = Fernet.generate_key()
+    fernet = Fernet(key)
+    keyring = KeyRing([key])
+    print(f"{'plaintext':>9} {'token B':>8} {'packet B':>9} {'saved':>6} {'token us':>9} {'packet us':>10}")
+    for size in sizes:
+        plaintext = "x" * size
+
+        def text_path(seq):
+            wire = fernet.encrypt(plaintext.encode()).decode().encode()
+            fernet.decrypt(wire.decode().encode()).decode()
+            return FRAME_HEADER.size + len(wire)
+
+        def packet_path(seq):
+            wire = keyring.seal(plaintext.encode(), seq)
+            keyring.open(wire)[3].decode()
+            return FRAME_HEADER.size + len(wire)
+
+        row = []
+        for path in (text_path, packet_path):
+            started = time.process_time()
+            for seq in range(count):
+                wire_bytes = path(seq)
+            row.append((wire_bytes, (time.process_time() - started) / count * 1e6))
+        (text_bytes, text_us), (packet_bytes, packet_us) = row
+        print(f"{size:>9} {text_bytes:>8} {packet_bytes:>9} {1 - packet_bytes / text_bytes:>6.0%} "
+              f"{text_us:>9.1f} {packet_us:>10.1f}")
+
+
+def main(max_frame=MAX_FRAME_SIZE, save_dir=RECEIVED_DIR, flush_delay=FLUSH_DELAY_SEC, compression="off",
+         history_path=HISTORY_DB):
     root = tk.Tk()
     root.title("Encryption App (LAN)(Nazeer Ahmad)")
     root.geometry("980x640")
     
-    sock = None
-    server_sock = None
-    incoming_queue = queue.Queue()
-    messages = {}
+    #Other threads post here; Tk gets one <<Incoming>> per burst instead of polling
+    inbox = UiInbox(lambda: root.event_generate("<<Incoming>>", when="tail"))
+    #History lives on disk; the Treeview only ever holds the rows on screen
+    store = MessageStore(history_path)
+    view = {"offset": 0, "rows": HISTORY_ROWS, "filters": {}, "total": store.count(), "dirty": False}
+    view["offset"] = max(0, view["total"] - view["rows"])
+    #Plaintext stays in memory only, for the most recently opened messages
+    plaintexts = OrderedDict()
+    queued = set()
+    locked = set()
+    #Sealed by Encrypt Preview, sent as-is by Send Message
+    pending = {}
+    sequence = itertools.count(1)
+    keyring = KeyRing()
+    #Files are written to disk on their own thread; only their status comes through the inbox
+    files = FileReceiver(save_dir, on_event=inbox.post, keyring=keyring,
+                         on_flow=lambda peer, reading: transport.set_reading(peer, reading))
+
+    #Incoming messages are decrypted here as they arrive, not on click
+    decrypt_jobs = queue.Queue()
+
+    def decrypt_worker():
+        while True:
+            msg_id, packet = decrypt_jobs.get()
+            try:
+                plaintext = keyring.open(packet)[3].decode()
+            except (InvalidToken, UnicodeDecodeError):
+                plaintext = None
+            except Exception as exc:
+                #One bad message must not stop decryption for the rest of the session
+                inbox.post("status", f"Could not decrypt message {msg_id}: {exc}")
+                plaintext = None
+            inbox.post("decrypted", msg_id, plaintext)
+
+    threading.Thread(target=decrypt_worker, daemon=True).start()
+
+    def on_frame(peer, payload):
+        if not files.handle(peer.name, payload):
+            inbox.post("message", peer_host(peer.name), payload)
+
+    #Network runs on its own asyncio thread; everything it reports comes back through the inbox
+    transport = LanTransport(
+        on_frame=on_frame,
+        on_status=lambda text: inbox.post("status", text),
+        max_frame=max_frame,
+        on_lost=lambda peer: files.drop_peer(peer.name),
+        flush_delay=flush_delay,
+    )
     
     
     main_frame = ttk.Frame(root, padding=12)
@@ -50,9 +1482,14 @@ def main():
 
     def set_status(text):
         status_label.config(text=f"Status: {text}")
+
+    def report_errors(future, prefix):
+        def done(f):
+            if not f.cancelled() and f.exception() is not None:
+                inbox.post("status", f"{prefix}: {f.exception()}")
+        future.add_done_callback(done)
         
     def start_server():
-        nonlocal server_sock, sock
         host = listen_ip_entry.get().strip() or "0.0.0.0"
         port_text = port_entry.get().strip()
         
@@ -61,25 +1498,9 @@ def main():
             return
         
         port = int(port_text)
-        
-        def server_thread():
-            nonlocal server_sock, sock
-            try:
-                server_sock = socket.socket(socket.AF_INET,socket.SOCK_STREAM)
-                server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR,1)
-                server_sock.bind((host, port))
-                server_sock.listen(1)
-                set_status(f"Listening on {host}:{port}")
-                client, addr = server_sock.accept()
-                sock = client
-                set_status(f"Connected to {addr[0]}:{addr[1]}")
-                start_reader_thread(sock)
-            except Exception as e:
-                set_status(f"Server error: {e}")
-        threading.Thread(target=server_thread, daemon=True).start()
+        report_errors(transport.listen(host, port), "Server error")
         
     def connect_to_peer():
-        nonlocal sock
         host = connect_ip_entry.get().strip()
         port_text = port_entry.get().strip()
         
@@ -90,75 +1511,40 @@ def main():
             set_status("Invalid port ")
             return
         port = int (port_text)
-        
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((host,port))
-            set_status(f"Connected to {host}:{port}")
-            start_reader_thread(sock)
-        except Exception as e:
-            set_status(f"Connection failed: {e}")
+        report_errors(transport.connect(host, port), "Connection failed")
             
     def disconnect():
-        nonlocal sock, server_sock
-        try:
-            if sock:
-                sock.close()
-        except Exception:
-            pass
-        try:
-            if server_sock:
-                server_sock.close()
-        except Exception:
-            pass
-        sock = None
-        server_sock = None
+        transport.disconnect()
         set_status("Disconnected")
-        
-    def send_frame(sock_obj, payload):
-        length = struct.pack("!I", len(payload))
-        sock_obj.sendall(length + payload)
-        
-    def recv_exact(sock_obj, size):
-        data = b""
-        while len(data) < size:
-            chunk = sock_obj.recv(size - len(data))
-            if not chunk:
-                raise ConnectionError("Socket closed")
-            data += chunk
-        return data
-    def recv_frame(sock_obj):
-        length_bytes = recv_exact(sock_obj, 4)
-        msg_len = struct.unpack("!I", length_bytes)[0]
-        if msg_len == 0:
-            return b""
-        return recv_exact(sock_obj, msg_len)
-    
-    def start_reader_thread(sock_obj):
-        def reader():
-            try:
-                while True:
-                    msg = recv_frame(sock_obj)
-                    incoming_queue.put(msg)
-            except Exception:
-                incoming_queue.put(None)
-        threading.Thread(target=reader, daemon=True).start()
     
-    def get_fernet():
-        key = key_entry.get().strip()
-        if not key:
-            set_status("Key REQUIRED")
-            return None
-        try:
-            return Fernet(key.encode())
-        except Exception:
-            set_status("Invalid Key")
+    def get_keyring():
+        #Keys are parsed once per edit of the key box, not per message
+        if keyring.multi is None:
+            set_status("Invalid Key" if key_var.get().strip() else "Key REQUIRED")
             return None
+        return keyring
+
+    def keys_changed(*_):
+        #Several keys can be pasted (space or comma separated); the first one encrypts
+        keyring.set_keys(key_var.get().replace(",", " ").split())
+        fingerprints = keyring.fingerprints()
+        if fingerprints:
+            older = f" (+{len(fingerprints) - 1} older)" if len(fingerprints) > 1 else ""
+            key_info_label.config(text=f"Active key: {fingerprints[0]}{older}")
+        else:
+            key_info_label.config(text="No valid key")
+        #A new key may open messages that arrived before it; the visible ones are retried now, the rest when scrolled to
+        locked.clear()
+        refresh_history()
         
     def generate_key():
         key = Fernet.generate_key().decode()
         key_entry.delete(0,"end")
         key_entry.insert(0,key)
+
+    def rotate_key():
+        #New key goes in front and encrypts from now on; the old ones still decrypt
+        key_entry.insert(0, Fernet.generate_key().decode() + " ")
         
     def copy_key():
         key = key_entry.get().strip()
@@ -176,107 +1562,212 @@ def main():
         key_entry.insert(0,text.strip())
         
     def encrypt_preview():
-        f = get_fernet()
+        f = get_keyring()
         if not f:
             return
         plaintext = input_text.get("1.0","end").strip()
         if not plaintext:
             set_status("Type a message first my guy")
             return
-        ciphertext = f.encrypt(plaintext.encode()).decode()
+        data = plaintext.encode()
+        #Only compressed when every connected peer said it can inflate
+        level = COMPRESSION_LEVELS[compress_var.get()] if transport.shared_codecs & FLAG_ZLIB else None
+        pending["packet"] = f.seal(data, next(sequence), level=level)
+        if pending["packet"][2] & FLAG_ZLIB:
+            set_status(f"Compressed {len(data):,} -> {len(pending['packet']):,} bytes")
         preview_text.config(state="normal")
         preview_text.delete("1.0","end")
-        preview_text.insert("1.0",ciphertext)
+        preview_text.insert("1.0",packet_preview(pending["packet"], limit=None))
         preview_text.config(state="disabled")
         
-    def decrypt_selected():
+    def show_detail(text):
+        detail_text.config(state="normal")
+        detail_text.delete("1.0","end")
+        detail_text.insert("1.0", text)
+        detail_text.config(state="disabled")
+
+    def selected_message():
         selection = history_tree.selection()
-        if not selection:
-            set_status("Select a message")
-            return
-        msg_id = selection[0]
-        msg = messages.get(msg_id)
+        return store.get(int(selection[0])) if selection else None
+
+    def message_text(msg_id, kind, note):
+        if kind == "file":
+            return note
+        if msg_id in plaintexts:
+            plaintexts.move_to_end(msg_id)
+            return plaintexts[msg_id]
+        return None
+
+    def decrypt_selected():
+        msg = selected_message()
         if not msg:
-            set_status("Message not found")
+            set_status("Select a message")
             return
-        if msg["plaintext"]:
-            detail_text.config(state="normal")
-            detail_text.delete("1.0","end")
-            detail_text.insert("1.0", msg["plaintext"])
-            detail_text.config(state="disabled")
+        msg_id, _ts, _direction, _peer, kind, packet, note = msg
+        text = message_text(msg_id, kind, note)
+        if text is not None:
+            show_detail(text)
             return
-        f = get_fernet()
+        f = get_keyring()
         if not f:
             return
         try:
-            plaintext = f.decrypt(msg["ciphertext"].encode()).decode()
-        except InvalidToken:
+            plaintext = f.open(packet)[3].decode()
+        except (InvalidToken, UnicodeDecodeError):
             set_status("Wrong key")
             return
-        msg["plaintext"] = plaintext
-        history_tree.set(msg_id, "status", "decrypted")
-        detail_text.config(state="normal")
-        detail_text.delete("1.0","end")
-        detail_text.insert("1.0", plaintext)
-        detail_text.config(state="disabled")
-        
-    def add_history(direction, ciphertext, plaintext=None):
-        timestamp = time.strftime("%H:%M:%S")
-        preview = ciphertext[:48] + ("..." if len(ciphertext) > 48 else "")
-        msg_id = str(time.time_ns())
-        messages[msg_id] = {"ciphertext": ciphertext, "plaintext": plaintext}
-        history_tree.insert("","end", iid=msg_id, values=(timestamp, direction, "encrypted", preview))
+        remember(msg_id, plaintext)
+        history_tree.set(str(msg_id), "status", "decrypted")
+        show_detail(plaintext)
+
+    def remember(msg_id, plaintext):
+        plaintexts[msg_id] = plaintext
+        plaintexts.move_to_end(msg_id)
+        while len(plaintexts) > PLAINTEXT_CACHE_ROWS:
+            plaintexts.popitem(last=False)
+
+    def add_history(direction, peer, packet=None, plaintext=None, note=None, kind="message", commit=True):
+        #Appended to the store; the view only redraws if the new row lands on screen
+        ts = time.time()
+        msg_id = store.append(direction, peer, packet, note, kind, ts, commit)
+        if plaintext is not None:
+            remember(msg_id, plaintext)
+        if MessageStore.matches(view["filters"], direction, peer, ts):
+            following = view["offset"] + view["rows"] >= view["total"]
+            view["total"] += 1
+            if following:
+                view["offset"] = max(0, view["total"] - view["rows"])
+            view["dirty"] = True
         return msg_id
+
+    def refresh_history():
+        view["dirty"] = False
+        rows = store.page(view["offset"], view["rows"], **view["filters"])
+        selection = history_tree.selection()
+        history_tree.delete(*history_tree.get_children())
+        missing = []
+        for msg_id, ts, direction, peer, kind, head, size, note in rows:
+            if kind == "file":
+                status, preview = "file", f"[file] {os.path.basename(note.rsplit(' (', 1)[0])}"
+            else:
+                status = "decrypted" if msg_id in plaintexts else "encrypted"
+                preview = packet_preview(head) + ("..." if size > len(head) else "")
+                if msg_id not in plaintexts and msg_id not in queued and msg_id not in locked:
+                    missing.append(msg_id)
+            stamp = time.strftime("%d %b %H:%M:%S", time.localtime(ts))
+            peer = BROADCAST_LABEL if peer == BROADCAST_PEER else peer
+            history_tree.insert("","end", iid=str(msg_id), values=(stamp, direction, peer, status, preview))
+        #Rows that scroll into view get decrypted in the background too
+        for msg_id, packet in store.packets(missing):
+            queued.add(msg_id)
+            decrypt_jobs.put((msg_id, packet))
+        keep = [iid for iid in selection if history_tree.exists(iid)]
+        if keep:
+            history_tree.selection_set(keep)
+        total = view["total"]
+        if total:
+            history_scroll.set(view["offset"] / total, (view["offset"] + len(rows)) / total)
+        else:
+            history_scroll.set(0, 1)
+
+    def scroll_history(*args):
+        #Scrollbar commands, in Tk's yview form
+        if args[0] == "moveto":
+            offset = int(float(args[1]) * view["total"])
+        else:
+            step = int(args[1]) * (view["rows"] if args[2] == "pages" else 1)
+            offset = view["offset"] + step
+        offset = max(0, min(offset, view["total"] - view["rows"]))
+        if offset != view["offset"]:
+            view["offset"] = offset
+            refresh_history()
+
+    def on_history_wheel(event):
+        if getattr(event, "num", None) == 4 or event.delta > 0:
+            scroll_history("scroll", -HISTORY_WHEEL_ROWS, "units")
+        else:
+            scroll_history("scroll", HISTORY_WHEEL_ROWS, "units")
+        return "break"
+
+    def on_history_resize(event):
+        row_height = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        rows = max(1, (event.height - row_height - 6) // row_height)
+        if rows != view["rows"]:
+            following = view["offset"] + view["rows"] >= view["total"]
+            view["rows"] = rows
+            view["offset"] = max(0, view["total"] - rows) if following else min(view["offset"], max(0, view["total"] - rows))
+            refresh_history()
+
+    def apply_filters(*_):
+        since = HISTORY_SINCE[since_var.get()]
+        view["filters"] = {
+            "direction": None if direction_var.get() == "all" else direction_var.get(),
+            "peer": {"all": None, BROADCAST_LABEL: BROADCAST_PEER}.get(peer_var.get(), peer_var.get()),
+            "since": None if since is None else time.time() - since,
+        }
+        view["total"] = store.count(**view["filters"])
+        view["offset"] = max(0, view["total"] - view["rows"])
+        refresh_history()
     
     def clear_compose():
+        pending.clear()
         input_text.delete("1.0","end")
         preview_text.config(state="normal")
         preview_text.delete("1.0","end")
         preview_text.config(state="disabled")
         
     def send_message():
-        if not sock:
+        if not transport.peer_count():
             set_status("Not connected")
             return
         plaintext = input_text.get("1.0","end").strip()
-        ciphertext = preview_text.get("1.0","end").strip()
-        if not ciphertext:
+        packet = pending.get("packet")
+        if not packet:
             set_status("Encrypt preview first")
             return
-        try:
-            send_frame(sock,ciphertext.encode())
-        except Exception as e:
-            set_status(f"send failed: {e}")
-            return
-        add_history("out", ciphertext, plaintext=plaintext if plaintext else None)
+        #Queued for every connected peer; the network thread does the actual send
+        transport.send(packet)
+        add_history("out", BROADCAST_PEER, packet, plaintext=plaintext if plaintext else None)
+        refresh_history()
         clear_compose()
 
-    def on_select_message(_event=None):
-        selection = history_tree.selection()
-        if not selection:
+    def send_file():
+        if not transport.peer_count():
+            set_status("Not connected")
+            return
+        if not get_keyring():
             return
-        msg_id = selection[0]
-        msg = messages.get(msg_id)
+        path = filedialog.askopenfilename(title="Send file")
+        if not path:
+            return
+        #Streamed in encrypted chunks by the network thread, never loaded whole
+        set_status(f"Sending {os.path.basename(path)}...")
+        started = time.perf_counter()
+        future = transport.send_file(keyring.keys[0], path)
+        report_errors(future, "File transfer failed")
+
+        def sent(f):
+            if not f.cancelled() and f.exception() is None:
+                size = f.result()
+                rate = size / 1e6 / max(time.perf_counter() - started, 1e-9)
+                inbox.post("status", f"Sent {os.path.basename(path)} ({size / 1e6:.1f} MB, {rate:.0f} MB/s)")
+                inbox.post("file", "out", BROADCAST_PEER, path, size)
+        future.add_done_callback(sent)
+
+    def on_select_message(_event=None):
+        msg = selected_message()
         if not msg:
             return
-        text = msg["plaintext"] if msg["plaintext"] else msg["ciphertext"]
-        detail_text.config(state="normal")
-        detail_text.delete("1.0","end")
-        detail_text.insert("1.0", text)
-        detail_text.config(state="disabled")
+        msg_id, _ts, _direction, _peer, kind, packet, note = msg
+        text = message_text(msg_id, kind, note)
+        show_detail(text if text is not None else packet_preview(packet, limit=None))
 
     def show_ciphertext():
-        selection = history_tree.selection()
-        if not selection:
-            return
-        msg_id = selection[0]
-        msg = messages.get(msg_id)
+        msg = selected_message()
         if not msg:
             return
-        detail_text.config(state="normal")
-        detail_text.delete("1.0","end")
-        detail_text.insert("1.0", msg["ciphertext"])
-        detail_text.config(state="disabled")
+        packet = msg[5]
+        show_detail(packet_preview(packet, limit=None) if packet else "")
 
     def copy_detail():
         text = detail_text.get("1.0","end").strip()
@@ -285,17 +1776,46 @@ def main():
         root.clipboard_clear()
         root.clipboard_append(text)
         
-    def poll_incoming():
-        try:
-            while True:
-                msg = incoming_queue.get_nowait()
-                if msg is None:
-                    set_status("Disconnected")
-                    break
-                add_history("in", msg.decode())
-        except queue.Empty:
-            pass
-        root.after(150, poll_incoming)
+    def drain_incoming(_event=None):
+        batch, more = inbox.take()
+        status = None
+        for kind, *event in batch:
+            if kind == "status":
+                status = event[0]
+                continue
+            if kind == "file":
+                direction, peer, path, size = event
+                add_history(direction, peer, note=f"{path} ({size:,} bytes)", kind="file", commit=False)
+                continue
+            if kind == "decrypted":
+                msg_id, plaintext = event
+                queued.discard(msg_id)
+                if plaintext is None:
+                    locked.add(msg_id)
+                    continue
+                remember(msg_id, plaintext)
+                if history_tree.exists(str(msg_id)):
+                    history_tree.set(str(msg_id), "status", "decrypted")
+                continue
+            peer, msg = event
+            msg_id = add_history("in", peer, msg, commit=False)
+            queued.add(msg_id)
+            decrypt_jobs.put((msg_id, msg))
+        #One commit, one status line and one redraw for the whole batch
+        store.commit()
+        if status is not None:
+            set_status(status)
+        if view["dirty"]:
+            refresh_history()
+        if more:
+            #Let Tk repaint and handle input before the next batch
+            root.after(UI_BATCH_GAP_MS, drain_incoming)
+
+    def on_close():
+        inbox.close()
+        transport.close()
+        store.close()
+        root.destroy()
     
     #Server start button
     start_server_button = ttk.Button(connection_frame, text="Start Server",command=start_server)
@@ -317,8 +1837,10 @@ def main():
     key_frame = ttk.LabelFrame(left_frame, text="Encryption keys", padding=10)
     key_frame.pack(fill="x", pady=(0, 10))
     
-    key_entry = ttk.Entry(key_frame, width = 60)
-    key_entry.grid(row=0, column=0, columnspan=3, sticky="we")
+    key_var = tk.StringVar()
+    key_entry = ttk.Entry(key_frame, width = 60, textvariable=key_var)
+    key_entry.grid(row=0, column=0, columnspan=4, sticky="we")
+    key_var.trace_add("write", keys_changed)
     
     generate_key_button = ttk.Button(key_frame, text="Generate Key", command=generate_key)
     generate_key_button.grid(row=1, column=0, sticky="w", pady=(8,0),)
@@ -328,6 +1850,12 @@ def main():
     
     paste_key_button = ttk.Button(key_frame, text="Paste Key", command=paste_key)
     paste_key_button.grid(row=1, column=2, sticky="w", padx=(8, 0), pady=(8, 0))
+
+    rotate_key_button = ttk.Button(key_frame, text="Rotate Key", command=rotate_key)
+    rotate_key_button.grid(row=1, column=3, sticky="w", padx=(8, 0), pady=(8, 0))
+
+    key_info_label = ttk.Label(key_frame, text="No valid key")
+    key_info_label.grid(row=2, column=0, columnspan=4, sticky="w", pady=(8, 0))
     
     #Message compose section wala section 
     
@@ -335,7 +1863,7 @@ def main():
     compose_frame.pack(fill="both", expand=True)
     
     input_text = tk.Text(compose_frame, height=8, wrap='word')
-    input_text.grid(row=0, column=0, columnspan=3, sticky="nsew")
+    input_text.grid(row=0, column=0, columnspan=4, sticky="nsew")
     
     encrypt_preview_button = ttk.Button(compose_frame, text="Encrypt Preview ", command=encrypt_preview)
     encrypt_preview_button.grid(row=1, column=0, sticky="w", pady=(8,0))
@@ -346,9 +1874,18 @@ def main():
     clear_button = ttk.Button(compose_frame, text="Clear", command=clear_compose)
     clear_button.grid(row=1, column=2, sticky="w", padx=(8,0), pady=(8,0))
     
+    send_file_button = ttk.Button(compose_frame, text="Send File", command=send_file)
+    send_file_button.grid(row=1, column=3, sticky="w", padx=(8,0), pady=(8,0))
+    
     ttk.Label(compose_frame, text="Encrypted preview").grid(row=2, column=0, sticky="w", pady=(8,0))
+    
+    compress_var = tk.StringVar(value=compression)
+    ttk.Label(compose_frame, text="Compression").grid(row=2, column=2, sticky="e", pady=(8,0))
+    compress_box = ttk.Combobox(compose_frame, textvariable=compress_var, values=list(COMPRESSION_LEVELS),
+                                state="readonly", width=6)
+    compress_box.grid(row=2, column=3, sticky="w", padx=(8,0), pady=(8,0))
     preview_text = tk.Text(compose_frame, height=8, wrap="word", state="disabled", background="#f0f0f0")
-    preview_text.grid(row=3, column=0, columnspan=3, sticky="nsew", pady=(4,0))
+    preview_text.grid(row=3, column=0, columnspan=4, sticky="nsew", pady=(4,0))
     
     compose_frame.grid_rowconfigure(0, weight=1)
     compose_frame.grid_rowconfigure(3, weight=1)
@@ -358,18 +1895,46 @@ def main():
     history_frame = ttk.LabelFrame(right_frame, text="Message History", padding=10)
     history_frame.pack(fill="both", expand=True, pady=(0,10))
     
-    columns = ("time", "dir", "status", "preview")
-    history_tree = ttk.Treeview(history_frame, columns=columns, show="headings", height=12)
+    #Filters (each one is backed by an index in the store)
+    filter_frame = ttk.Frame(history_frame)
+    filter_frame.pack(fill="x", pady=(0,6))
+    direction_var = tk.StringVar(value="all")
+    peer_var = tk.StringVar(value="all")
+    since_var = tk.StringVar(value="all")
+    ttk.Label(filter_frame, text="Dir").pack(side="left")
+    ttk.Combobox(filter_frame, textvariable=direction_var, values=["all", "in", "out"], state="readonly",
+                 width=4).pack(side="left", padx=(4,10))
+    ttk.Label(filter_frame, text="Peer").pack(side="left")
+    peer_box = ttk.Combobox(filter_frame, textvariable=peer_var, state="readonly", width=14,
+                            postcommand=lambda: peer_box.config(values=["all", BROADCAST_LABEL] + store.peers()))
+    peer_box.pack(side="left", padx=(4,10))
+    ttk.Label(filter_frame, text="Since").pack(side="left")
+    ttk.Combobox(filter_frame, textvariable=since_var, values=list(HISTORY_SINCE), state="readonly",
+                 width=5).pack(side="left", padx=(4,0))
+    for var in (direction_var, peer_var, since_var):
+        var.trace_add("write", apply_filters)
+    
+    #The scrollbar drives paging instead of scrolling the Treeview itself
+    history_scroll = ttk.Scrollbar(history_frame, orient="vertical", command=scroll_history)
+    history_scroll.pack(side="right", fill="y")
+    columns = ("time", "dir", "peer", "status", "preview")
+    history_tree = ttk.Treeview(history_frame, columns=columns, show="headings", height=HISTORY_ROWS)
     history_tree.heading("time", text="Time")
     history_tree.heading("dir", text="Dir")
+    history_tree.heading("peer", text="Peer")
     history_tree.heading("status", text="Status")
     history_tree.heading("preview", text="Cipher preview")
-    history_tree.column("time", width=90)
-    history_tree.column("dir", width=50)
-    history_tree.column("status", width=90)
-    history_tree.column("preview", width=240)
+    history_tree.column("time", width=120)
+    history_tree.column("dir", width=40)
+    history_tree.column("peer", width=100)
+    history_tree.column("status", width=80)
+    history_tree.column("preview", width=200)
     history_tree.pack(fill="both", expand=True)
     history_tree.bind("<<TreeviewSelect>>", on_select_message)
+    history_tree.bind("<MouseWheel>", on_history_wheel)
+    history_tree.bind("<Button-4>", on_history_wheel)
+    history_tree.bind("<Button-5>", on_history_wheel)
+    history_tree.bind("<Configure>", on_history_resize)
     
     #Message deatilas
     detail_frame = ttk.LabelFrame(right_frame, text="Selected message", padding=10)
@@ -388,11 +1953,68 @@ def main():
     copy_text_button.grid(row=1, column=2, sticky="w", padx=(8,0), pady=(8,0))
     
     
-    poll_incoming()
+    refresh_history()
+    root.bind("<<Incoming>>", drain_incoming)
+    #Picks up anything posted before the window could take events
+    drain_incoming()
+    root.protocol("WM_DELETE_WINDOW", on_close)
     
     root.mainloop()
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="Encryption App (LAN)")
+    parser.add_argument("--load-test", type=int, nargs="?", const=LOAD_TEST_PEERS, metavar="PEERS",
+                        help="localhost echo load test with this many simultaneous peers (no GUI)")
+    parser.add_argument("--messages", type=int, default=LOAD_TEST_MESSAGES, help="round trips per peer for --load-test")
+    parser.add_argument("--size", type=int, default=LOAD_TEST_PAYLOAD, help="payload bytes for --load-test")
+    parser.add_argument("--max-frame-mb", type=float, default=MAX_FRAME_SIZE / (1024 * 1024),
+                        help="drop peers that announce a bigger frame than this")
+    parser.add_argument("--flush-ms", type=float, default=FLUSH_DELAY_SEC * 1000,
+                        help="hold outgoing frames up to this long so bursts go out in fewer writes")
+    parser.add_argument("--compress", choices=list(COMPRESSION_LEVELS), default="off",
+                        help="zlib level for messages (skipped for small or incompressible ones)")
+    parser.add_argument("--history", default=HISTORY_DB, help="SQLite file that keeps the encrypted message history")
+    parser.add_argument("--save-dir", default=RECEIVED_DIR, help="where received files are written")
+    parser.add_argument("--bench-send", action="store_true",
+                        help="small-message throughput and latency with and without write coalescing (no GUI)")
+    parser.add_argument("--bench-recv", action="store_true",
+                        help="compare receive throughput of the old and new frame readers (no GUI)")
+    parser.add_argument("--bench-decrypt", action="store_true",
+                        help="compare bulk history decrypt throughput with and without the key cache (no GUI)")
+    parser.add_argument("--bench-history", type=int, nargs="?", const=HISTORY_BENCH_MESSAGES, metavar="MESSAGES",
+                        help="time appends, reopening and paging a message store this big (no GUI)")
+    parser.add_argument("--bench-inbox", type=int, nargs="?", const=INBOX_BENCH_MESSAGES, metavar="MESSAGES",
+                        help="delivery latency and longest UI stall, 150 ms polling vs the batched inbox (no GUI)")
+    parser.add_argument("--bench-compress", action="store_true",
+                        help="compression ratio and throughput per payload class (no GUI)")
+    parser.add_argument("--bench-wire", action="store_true",
+                        help="compare wire bytes and CPU per message for text tokens and binary packets (no GUI)")
+    parser.add_argument("--bench-file", type=int, nargs="?", const=FILE_BENCH_MB, metavar="MB",
+                        help="stream a file of this size over loopback and report MB/s and peak RSS (no GUI)")
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    if args.bench_send:
+        run_send_bench()
+    elif args.bench_recv:
+        run_recv_bench()
+    elif args.bench_decrypt:
+        run_decrypt_bench()
+    elif args.bench_history:
+        run_history_bench(args.bench_history)
+    elif args.bench_inbox:
+        run_inbox_bench(args.bench_inbox)
+    elif args.bench_compress:
+        run_compress_bench()
+    elif args.bench_wire:
+        run_wire_bench()
+    elif args.bench_file:
+        run_file_bench(args.bench_file)
+    elif args.load_test:
+        run_load_test(args.load_test, args.messages, args.size)
+    else:
+        main(int(args.max_frame_mb * 1024 * 1024), args.save_dir, args.flush_ms / 1000, args.compress, args.history)
     
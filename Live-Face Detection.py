@@ -2,60 +2,465 @@ import cv2
 import os
 import time
 import json
+import math
+import queue
+import argparse
+import tempfile
+import http.server
 import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from collections import deque
+from contextlib import contextmanager, redirect_stdout
 import tkinter as tk
 from tkinter import messagebox
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 import numpy as np
 import sys
 
-face_cascade = cv2.CascadeClassifier(
-    cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
-)
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; the benchmark then reports no peak RSS
+    resource = None
 
-cap = cv2.VideoCapture(0)
-
-if not cap.isOpened():
-    raise RuntimeError("Could not open the camera.")
+CASCADE_PATH = cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+face_cascade = cv2.CascadeClassifier(CASCADE_PATH)
 
 # Settings for data capture
 BASE_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
 DATA_DIR = os.path.join(BASE_DIR, "data")
 SAMPLES_PER_PERSON = 20
 CAPTURE_DELAY_SEC = 0.2
+STATUS_POLL_MS = 100
 MODEL_PATH = os.path.join(BASE_DIR, "trainer.yml")
 LABELS_PATH = os.path.join(BASE_DIR, "labels.json")
+MANIFEST_PATH = os.path.join(BASE_DIR, "trainer_manifest.json")
 CONFIDENCE_THRESHOLD = 65
+FACE_SIZE = (200, 200)
 
-os.makedirs(DATA_DIR, exist_ok=True)
+# Settings for threshold calibration (--calibrate); thresholds.json overrides
+# CONFIDENCE_THRESHOLD per person in the live loop when it exists
+THRESHOLDS_PATH = os.path.join(BASE_DIR, "thresholds.json")
+CALIBRATION_FOLDS = 5
+CALIBRATION_TARGET_FAR = 0.01
+CALIBRATION_MAX_THRESHOLD = 200
+CALIBRATION_GALLERY_SIZES = (8, 4, 2)
 
-print("Controls:")
-print("  Use the GUI window to set name and start/stop capture")
-print("  q = quit (camera window)")
+# Decoded-face cache used by training (one memory-mapped array for all samples)
+CACHE_DIR = os.path.join(BASE_DIR, "face_cache")
+PARALLEL_DECODE_MIN = 64
+DECODE_CHUNK_SIZE = 64
 
-def load_training_data(data_dir):
-    images = []
-    labels = []
-    label_map = {}
-    current_id = 0
+# Settings for the background sample writer used by capture mode
+SAMPLE_QUEUE_SIZE = 32
+SAMPLE_WRITE_BATCH = 8
+SAMPLE_MIN_SIDE = 80
+SAMPLE_MIN_SHARPNESS = 50.0
+SAMPLE_MIN_SYMMETRY = 0.75
+SAMPLE_DUPLICATE_DIFF = 3.0
+EQUALIZE_FACES = False
+
+# Settings for the capture -> detect -> recognise -> render pipeline
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+DETECT_QUEUE_SIZE = 2
+RENDER_QUEUE_SIZE = 2
+RECOGNITION_WORKERS = 4
+RECOGNITION_INFLIGHT_PER_SOURCE = 8
+GRAY_BUFFERS = 8
+STAGE_POLL_SEC = 0.1
+
+# Settings for batch recognition (vectorised LBPH for all faces of a frame)
+CHI_SQUARE_BIN_BLOCK = 128
+LBP_CHUNK_FACES = 2
+
+# Settings for the gallery index used by batch recognition
+GALLERY_INDEX = "exhaustive"
+CENTROID_TOP_K = 8
+BENCH_GALLERY_PEOPLE = (100, 400, 1000)
+BENCH_GALLERY_SAMPLES = 10
+BENCH_QUERIES = 50
+BENCH_TOP_K = (4, 8, 16)
+BENCH_FACE_COUNTS = (1, 5, 20)
+
+# Settings for the deterministic pipeline benchmark (--bench-suite)
+BENCH_SEED = 0
+BENCH_PEOPLE = ("Nazeer", "Solomon")
+BENCH_FRAMES = 240
+BENCH_FRAME_SIZE = (640, 480)
+BENCH_SEGMENT_FRAMES = 24
+BENCH_MAX_FACES = 2
+BENCH_FACE_SIDE = (110, 190)
+BENCH_WARMUP_FRAMES = 24
+BENCH_MODES = (("default", False, False), ("tracker", True, False), ("batch", False, True))
+BENCH_FPS_TOLERANCE = 0.15
+BENCH_RSS_TOLERANCE = 0.20
+
+# Settings for pipeline instrumentation (off unless --metrics/--metrics-log/--metrics-port)
+METRICS_WINDOW = 1000
+METRICS_LOG_INTERVAL_SEC = 5.0
+METRICS_OVERLAY_REFRESH_SEC = 1.0
+METRICS_STAGES = ("read", "cvtColor", "detect", "predict", "draw", "display", "latency")
+
+# Settings for offline batch processing of recorded footage
+OFFLINE_CHUNK_FRAMES = 16
+
+# Settings for tracker mode (cascade every N frames, optical flow in between)
+DETECT_EVERY_N = 5
+TRACK_IOU_THRESHOLD = 0.3
+TRACK_MIN_POINTS = 5
+RECOGNITION_REFRESH_FRAMES = 30
+RECOGNITION_RESIZE_DRIFT = 0.3
+
+# Settings for downscaled / region-of-interest detection
+DETECT_SCALE = 1.0
+ROI_MARGIN = 0.5
+ROI_REFRESH_FRAMES = 15
 
+def assign_label_ids(data_dir, label_map):
+    # People already in the model keep their IDs and newcomers get the next
+    # free one, so enrolling someone who sorts first doesn't renumber everybody
+    label_map = dict(label_map)
+    known = set(label_map.values())
+    next_id = max(label_map, default=-1) + 1
+    for person in sorted(os.listdir(data_dir)):
+        if person in known or not os.path.isdir(os.path.join(data_dir, person)):
+            continue
+        label_map[next_id] = person
+        next_id += 1
+    return label_map
+
+def scan_samples(data_dir, label_map):
+    # One manifest entry (path, mtime, size, label) per sample image on disk
+    person_ids = {person: label_id for label_id, person in label_map.items()}
+    entries = []
     for person in sorted(os.listdir(data_dir)):
         person_dir = os.path.join(data_dir, person)
-        if not os.path.isdir(person_dir):
+        if person not in person_ids or not os.path.isdir(person_dir):
             continue
+        for filename in sorted(os.listdir(person_dir)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            stat = os.stat(os.path.join(person_dir, filename))
+            entries.append({
+                "path": f"{person}/{filename}",
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "label": person_ids[person],
+            })
+    return entries
 
-        label_map[current_id] = person
+def decode_faces(data_dir, paths):
+    # Runs in a worker process: decode a batch of one person's samples into
+    # normalised grey faces
+    faces = []
+    for path in paths:
+        img = cv2.imread(os.path.join(data_dir, path), cv2.IMREAD_GRAYSCALE)
+        faces.append(None if img is None else cv2.resize(img, FACE_SIZE))
+    return paths, faces
 
-        for filename in os.listdir(person_dir):
-            if not filename.lower().endswith((".png", ".jpg", ".jpeg")):
-                continue
-            path = os.path.join(person_dir, filename)
-            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
-            if img is None:
+def decode_samples(data_dir, entries):
+    batches = {}
+    for entry in entries:
+        batches.setdefault(entry["path"].split("/")[0], []).append(entry["path"])
+    jobs = [
+        paths[i:i + DECODE_CHUNK_SIZE]
+        for paths in batches.values()
+        for i in range(0, len(paths), DECODE_CHUNK_SIZE)
+    ]
+
+    decoded = {}
+    if len(entries) < PARALLEL_DECODE_MIN:
+        results = (decode_faces(data_dir, paths) for paths in jobs)
+        for paths, faces in results:
+            decoded.update(zip(paths, faces))
+        return decoded
+
+    # Spawned, not forked: retrain runs this while the capture, detect and Tk
+    # threads are live, and a forked child can inherit one of their locks held
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as pool:
+        for paths, faces in pool.map(decode_faces, [data_dir] * len(jobs), jobs):
+            decoded.update(zip(paths, faces))
+    return decoded
+
+def read_samples_uncached(data_dir, entries):
+    decoded = decode_samples(data_dir, entries)
+    images = []
+    labels = []
+    loaded = []
+    for entry in entries:
+        face = decoded.get(entry["path"])
+        if face is None:
+            continue
+        images.append(face)
+        labels.append(entry["label"])
+        loaded.append(entry)
+    return images, np.array(labels, dtype=np.int32), loaded
+
+def load_training_data(data_dir, label_map=None):
+    label_map = assign_label_ids(data_dir, label_map or {})
+    images, labels, _loaded = read_samples(data_dir, scan_samples(data_dir, label_map))
+    return images, labels, label_map
+
+def load_labels_map():
+    if not os.path.exists(LABELS_PATH):
+        return {}
+    with open(LABELS_PATH, "r", encoding="utf-8") as f:
+        labels_map = json.load(f)
+    # JSON keys are strings; convert to int for lookup consistency
+    return {int(k): v for k, v in labels_map.items()}
+
+def load_manifest():
+    if not os.path.exists(MANIFEST_PATH):
+        return None
+    with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+        return json.load(f)["samples"]
+
+def atomic_save(path, write):
+    # Write to a temp file in the same directory, then rename over the target,
+    # so a crash mid-save leaves the previous file intact instead of a torn one
+    directory, filename = os.path.split(path)
+    stem, ext = os.path.splitext(filename)
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{stem}-", suffix=ext, dir=directory)
+    os.close(fd)
+    # mkstemp creates the file 0600; keep the permissions a plain open() would give
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(tmp_path, 0o666 & ~umask)
+    try:
+        write(tmp_path)
+        with open(tmp_path, "r+b") as f:
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def save_json(path, data):
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+    atomic_save(path, write)
+
+class FaceCache:
+    # Every decoded 200x200 grey sample lives in one memory-mapped faces.npy
+    # with a matching labels.npy and a path -> row index. Rows are reused while
+    # the file's mtime and size are unchanged, so startup and retrain only pay
+    # JPEG decoding for new or edited samples. Freshly captured samples wait in
+    # memory and are written with the next load() or flush(), not per batch.
+    def __init__(self, data_dir, cache_dir=CACHE_DIR):
+        self.data_dir = data_dir
+        self.faces_path = os.path.join(cache_dir, "faces.npy")
+        self.labels_path = os.path.join(cache_dir, "labels.npy")
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self.failed_path = os.path.join(cache_dir, "failed.json")
+        self.lock = threading.Lock()
+        self.faces = None
+        self.index = {}
+        self.pending = {}
+        self.failed = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._open()
+
+    def _open(self):
+        self.faces = None
+        self.index = {}
+        # Files that could not be decoded, by mtime and size, so they are not
+        # decoded again on every load until they change
+        try:
+            with open(self.failed_path, "r", encoding="utf-8") as f:
+                self.failed = json.load(f)
+        except (OSError, ValueError):
+            self.failed = {}
+        if not (os.path.exists(self.faces_path) and os.path.exists(self.index_path)):
+            return
+        try:
+            faces = np.load(self.faces_path, mmap_mode="r")
+            with open(self.index_path, "r", encoding="utf-8") as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable face cache ({e}).")
+            return
+        if faces.shape[1:] == FACE_SIZE[::-1] and len(index) == len(faces):
+            self.faces, self.index = faces, index
+
+    def load(self, entries, prune=False):
+        with self.lock:
+            missing = [
+                entry for entry in entries
+                if not self._is_fresh(entry) and not self._same_file(self.failed.get(entry["path"]), entry)
+            ]
+            # Freshly captured samples come from memory instead of the JPEG
+            captured = {}
+            for entry in missing:
+                held = self.pending.get(entry["path"])
+                if held is not None and self._same_file(held[0], entry):
+                    captured[entry["path"]] = held[1]
+            to_decode = [entry for entry in missing if entry["path"] not in captured]
+            decoded = decode_samples(self.data_dir, to_decode) if to_decode else {}
+            decoded.update(captured)
+
+            wanted = {entry["path"] for entry in entries}
+            stale = prune and any(path not in wanted for path in self.index)
+            self._note_failures(entries, decoded, wanted if prune else None)
+            # A file that no longer decodes only matters if it has a row to drop
+            changed = any(face is not None or path in self.index for path, face in decoded.items())
+            if changed or stale:
+                # The rest of the captured samples are written along with this
+                # rewrite (pruning drops them: they are not in entries)
+                extra = []
+                if not prune:
+                    for path, (entry, face) in self.pending.items():
+                        if path not in wanted:
+                            extra.append(entry)
+                            decoded[path] = face
+                self._rewrite(entries + extra, decoded, prune)
+                self.pending = {}
+
+            images = []
+            labels = []
+            loaded = []
+            for entry in entries:
+                cached = self.index.get(entry["path"])
+                if cached is None:
+                    continue
+                images.append(self.faces[cached["row"]])
+                labels.append(entry["label"])
+                loaded.append(entry)
+            return images, np.array(labels, dtype=np.int32), loaded
+
+    def _note_failures(self, entries, decoded, wanted):
+        failed = dict(self.failed)
+        for entry in entries:
+            path = entry["path"]
+            if path not in decoded:
                 continue
-            images.append(img)
-            labels.append(current_id)
-        current_id += 1
-    return images, np.array(labels), label_map
+            if decoded[path] is None:
+                failed[path] = {"mtime": entry["mtime"], "size": entry["size"]}
+            else:
+                failed.pop(path, None)
+        if wanted is not None:
+            failed = {path: meta for path, meta in failed.items() if path in wanted}
+        if failed != self.failed:
+            self.failed = failed
+            save_json(self.failed_path, failed)
+
+    def _is_fresh(self, entry):
+        return self._same_file(self.index.get(entry["path"]), entry)
+
+    @staticmethod
+    def _same_file(cached, entry):
+        return cached is not None and (cached["mtime"], cached["size"]) == (entry["mtime"], entry["size"])
+
+    def _rewrite(self, entries, decoded, prune):
+        # Rows come either from the old mmap (still valid) or from new decodes
+        rows = []
+        replaced = {entry["path"] for entry in entries if entry["path"] in decoded}
+        if not prune:
+            for path, cached in self.index.items():
+                if path not in replaced:
+                    rows.append((path, cached, cached["row"]))
+        for entry in entries:
+            path = entry["path"]
+            if path in decoded:
+                if decoded[path] is not None:
+                    rows.append((path, entry, decoded[path]))
+            elif prune and path in self.index:
+                rows.append((path, entry, self.index[path]["row"]))
+
+        def write_faces(tmp_path):
+            out = np.lib.format.open_memmap(
+                tmp_path, mode="w+", dtype=np.uint8, shape=(len(rows),) + FACE_SIZE[::-1]
+            )
+            for i, (_path, _meta, face) in enumerate(rows):
+                out[i] = self.faces[face] if isinstance(face, int) else face
+            out.flush()
+            del out
+            # Release the old mapping before it is replaced (required on Windows)
+            self.faces = None
+
+        def write_labels(tmp_path):
+            np.save(tmp_path, np.array([meta["label"] for _path, meta, _face in rows], dtype=np.int32))
+
+        atomic_save(self.faces_path, write_faces)
+        atomic_save(self.labels_path, write_labels)
+        save_json(self.index_path, {
+            path: {"row": i, "mtime": meta["mtime"], "size": meta["size"], "label": meta["label"]}
+            for i, (path, meta, _face) in enumerate(rows)
+        })
+        self._open()
+
+    def add(self, entries, faces):
+        # Samples that were just written and are already decoded in memory;
+        # kept until the next load() or flush() so capturing does no cache I/O
+        with self.lock:
+            for entry, face in zip(entries, faces):
+                self.pending[entry["path"]] = (entry, face)
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            entries = [entry for entry, _face in self.pending.values()]
+            self._rewrite(entries, {path: face for path, (_entry, face) in self.pending.items()}, prune=False)
+            self.pending = {}
+
+face_cache = None
+face_cache_lock = threading.Lock()
+
+def get_face_cache():
+    # Retrain and the sample writer both get here; only one may build the cache
+    global face_cache
+    with face_cache_lock:
+        if face_cache is None:
+            face_cache = FaceCache(DATA_DIR)
+        return face_cache
+
+def read_samples(data_dir, entries, prune=False):
+    if data_dir != DATA_DIR:
+        return read_samples_uncached(data_dir, entries)
+    return get_face_cache().load(entries, prune=prune)
+
+def save_model(recognizer, labels_map, manifest):
+    # Labels first (they only ever grow), the manifest last: if we die in
+    # between, the next retrain redoes the delta rather than missing it
+    save_json(LABELS_PATH, labels_map)
+    atomic_save(MODEL_PATH, recognizer.save)
+    save_json(MANIFEST_PATH, {"samples": manifest})
+
+def diff_manifest(manifest, entries):
+    # Files flagged "failed" were unreadable last time: skipped while they are
+    # unchanged, treated as new once they change, and never in the model
+    previous = {entry["path"]: entry for entry in manifest}
+    current = {entry["path"] for entry in entries}
+    added = []
+    changed = []
+    for entry in entries:
+        old = previous.get(entry["path"])
+        same = old is not None and (old["mtime"], old["size"], old["label"]) == (entry["mtime"], entry["size"], entry["label"])
+        if old is None or (old.get("failed") and not same):
+            added.append(entry)
+        elif not same:
+            changed.append(entry)
+    removed = [path for path, old in previous.items() if path not in current and not old.get("failed")]
+    return added, changed, removed
+
+def with_failures(samples, entries):
+    # The manifest also lists the files that could not be read, so the next
+    # retrain doesn't pick them up as new samples again
+    have = {entry["path"] for entry in samples}
+    return samples + [dict(entry, failed=True) for entry in entries if entry["path"] not in have]
+
+def train_full_model(labels_map):
+    labels_map = assign_label_ids(DATA_DIR, labels_map)
+    entries = scan_samples(DATA_DIR, labels_map)
+    images, labels, loaded = read_samples(DATA_DIR, entries, prune=True)
+    if len(images) == 0:
+        return None, labels_map, []
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer.train(images, labels)
+    return recognizer, labels_map, with_failures(loaded, entries)
 
 def show_error_and_exit(message):
     root = tk.Tk()
@@ -64,46 +469,1424 @@ def show_error_and_exit(message):
     root.destroy()
     raise SystemExit(1)
 
-recognizer = cv2.face.LBPHFaceRecognizer_create()
-
-if os.path.exists(MODEL_PATH) and os.path.exists(LABELS_PATH):
+def read_model():
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
     recognizer.read(MODEL_PATH)
-    with open(LABELS_PATH, "r", encoding="utf-8") as f:
-        labels_map = json.load(f)
-    # JSON keys are strings; convert to int for lookup consistency
-    labels_map = {int(k): v for k, v in labels_map.items()}
-    print(f"Loaded existing model from {MODEL_PATH}.")
-else:
+    return recognizer, load_labels_map()
+
+def load_or_train_model(headless=False):
+    if os.path.exists(MODEL_PATH) and os.path.exists(LABELS_PATH):
+        try:
+            recognizer, labels_map = read_model()
+            print(f"Loaded existing model from {MODEL_PATH}.")
+            return recognizer, labels_map
+        except (cv2.error, ValueError) as e:
+            print(f"Could not load {MODEL_PATH} ({e}); retraining from {DATA_DIR}.")
+
     print("Training recogniser...")
-    train_images, train_labels, labels_map = load_training_data(DATA_DIR)
+    recognizer, labels_map, manifest = train_full_model(load_labels_map())
 
-    if len(train_images) == 0:
-        show_error_and_exit(
+    if recognizer is None:
+        message = (
             "No training data found.\n"
             "Capture samples first, then click Retrain."
         )
+        if headless:
+            raise SystemExit(message)
+        show_error_and_exit(message)
 
-    recognizer.train(train_images, train_labels)
-    recognizer.save(MODEL_PATH)
-
-    with open(LABELS_PATH, "w", encoding="utf-8") as f:
-        json.dump(labels_map, f)
+    save_model(recognizer, labels_map, manifest)
     print(f"Training completed and model is saved to {MODEL_PATH}.")
+    return recognizer, labels_map
 
-# ---- Simple GUI for name entry and capture control ----
-current_name = None
-saved_count = 0
-last_save_time = 0.0
+class ReadWriteLock:
+    # Recognition workers predict concurrently; an incremental update() waits
+    # for them to finish and has the model to itself while it runs
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def reading(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def writing(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writing or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+# Recogniser and its label map live in one tuple so a retrain swaps both at once
+active_model = (None, {})
+model_lock = ReadWriteLock()
+retrain_thread = None
+
+# ---- Frame sources and pipeline plumbing ----
+class FrameSource:
+    # Camera index, video file or a directory of still frames behind one read() call
+    def __init__(self, source):
+        self.cap = None
+        self.frame_paths = None
+        self.position = 0
+        self.live = False
+
+        if os.path.isdir(source):
+            self.frame_paths = [
+                os.path.join(source, name)
+                for name in sorted(os.listdir(source))
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            ]
+        elif source.isdigit():
+            self.cap = cv2.VideoCapture(int(source))
+            self.live = True
+        elif "://" in source:
+            # Network streams (RTSP/HTTP) behave like cameras
+            self.cap = cv2.VideoCapture(source)
+            self.live = True
+        else:
+            self.cap = cv2.VideoCapture(source)
+
+    def is_opened(self):
+        if self.frame_paths is not None:
+            return len(self.frame_paths) > 0
+        return self.cap.isOpened()
+
+    def read(self):
+        if self.frame_paths is None:
+            return self.cap.read()
+        while self.position < len(self.frame_paths):
+            frame = cv2.imread(self.frame_paths[self.position])
+            self.position += 1
+            if frame is not None:
+                return True, frame
+        return False, None
+
+    def release(self):
+        if self.cap is not None:
+            self.cap.release()
+
+class DropOldestQueue(queue.Queue):
+    # Bounded queue; when full, put_latest() evicts the oldest item instead of blocking
+    def __init__(self, maxsize):
+        super().__init__(maxsize)
+        self.dropped = 0
+
+    def put_latest(self, item):
+        with self.mutex:
+            if 0 < self.maxsize <= self._qsize():
+                self._get()
+                self.dropped += 1
+                self.unfinished_tasks -= 1
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+class FrameRing:
+    # Preallocated frame slots in one shared-memory block. The producer fills a
+    # slot and hands workers (slot, seq) instead of pickled pixels; workers map
+    # the same block and read NumPy views. Every slot has a reference count and
+    # a sequence number. When all slots are still referenced a live producer
+    # overwrites the oldest one (bumping its seq) instead of waiting, and a
+    # reader that lagged behind sees the seq change and drops that frame.
+    def __init__(self, slots, shape, freed=None, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.freed = freed if freed is not None else multiprocessing.Condition()
+        header_bytes = slots * 2 * 8
+        frame_bytes = int(np.prod(self.shape))
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=header_bytes + slots * frame_bytes)
+        # header[slot] = (references, seq)
+        self.header = np.ndarray((slots, 2), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((slots,) + self.shape, dtype=np.uint8, buffer=self.shm.buf, offset=header_bytes)
+        if self.owner:
+            self.header[:] = 0
+        self.next_slot = 0
+        self.overwritten = 0
+
+    def spec(self):
+        # Everything a worker process needs to attach()
+        return self.slots, self.shape, self.freed, self.shm.name
+
+    @classmethod
+    def attach(cls, spec):
+        slots, shape, freed, name = spec
+        return cls(slots, shape, freed, name)
+
+    def acquire(self, overwrite=False, references=1):
+        # Producer side: a slot to fill, already holding its references
+        with self.freed:
+            while True:
+                for i in range(self.slots):
+                    slot = (self.next_slot + i) % self.slots
+                    if self.header[slot, 0] == 0:
+                        break
+                else:
+                    if not overwrite:
+                        self.freed.wait(0.1)
+                        continue
+                    # Every slot is in use: reuse the oldest, its readers will notice
+                    slot = self.next_slot
+                    self.overwritten += 1
+                self.header[slot, 0] = references
+                self.header[slot, 1] += 1
+                self.next_slot = (slot + 1) % self.slots
+                return slot, int(self.header[slot, 1])
+
+    def view(self, slot, seq):
+        # Reader side: the frame as a view into shared memory, or None if overwritten
+        if self.header[slot, 1] != seq:
+            return None
+        return self.frames[slot]
+
+    def release(self, slot, seq):
+        # False when the slot was overwritten while it was being read
+        with self.freed:
+            if self.header[slot, 1] != seq:
+                return False
+            self.header[slot, 0] -= 1
+            if self.header[slot, 0] == 0:
+                self.freed.notify_all()
+            return True
+
+    def close(self):
+        self.header = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+class GrayBuffers:
+    # Rotating preallocated grey frames for the detect stage. A buffer is only
+    # reused after the recognitions submitted on it have finished.
+    def __init__(self, count=GRAY_BUFFERS):
+        self.buffers = [None] * count
+        self.pending = [[] for _ in range(count)]
+        self.next_buffer = 0
+
+    def convert(self, frame):
+        i = self.next_buffer
+        self.next_buffer = (i + 1) % len(self.buffers)
+        wait(self.pending[i])
+        self.pending[i] = []
+        gray = self.buffers[i]
+        if gray is None or gray.shape != frame.shape[:2]:
+            gray = self.buffers[i] = np.empty(frame.shape[:2], dtype=np.uint8)
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+        return i, gray
+
+    def hold(self, i, results):
+        # results are futures or BatchSlots wrapping one
+        self.pending[i].extend(getattr(result, "future", result) for result in results)
+
+class StageMetrics:
+    # Rolling per-stage latency windows (for p50/p95/p99), cumulative totals for
+    # the Prometheus endpoint, plus frame and drop counters. Stages call
+    # observe(); when instrumentation is off the module-level metrics is None
+    # and the hot loops skip it entirely.
+    def __init__(self, window=METRICS_WINDOW):
+        self.lock = threading.Lock()
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.counters = {}
+        self.gauges = {}
+        self.frame_times = deque(maxlen=window)
+        self.started = time.time()
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            samples = self.samples.get(stage)
+            if samples is None:
+                samples = self.samples[stage] = deque(maxlen=self.window)
+                self.totals[stage] = [0, 0.0]
+            samples.append(seconds)
+            total = self.totals[stage]
+            total[0] += 1
+            total[1] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def frame_done(self):
+        with self.lock:
+            self.frame_times.append(time.perf_counter())
+            self.counters["frames"] = self.counters.get("frames", 0) + 1
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def snapshot(self):
+        with self.lock:
+            samples = {stage: np.array(values) for stage, values in self.samples.items()}
+            totals = {stage: tuple(total) for stage, total in self.totals.items()}
+            counters = dict(self.counters)
+            frame_times = list(self.frame_times)
+        for name, read in self.gauges.items():
+            counters[name] = read()
+
+        fps = 0.0
+        if len(frame_times) > 1 and frame_times[-1] > frame_times[0]:
+            fps = (len(frame_times) - 1) / (frame_times[-1] - frame_times[0])
+        stages = {}
+        for stage, values in samples.items():
+            if len(values) == 0:
+                continue
+            p50, p95, p99 = np.percentile(values, (50, 95, 99)) * 1000.0
+            stages[stage] = {
+                "p50_ms": round(float(p50), 3),
+                "p95_ms": round(float(p95), 3),
+                "p99_ms": round(float(p99), 3),
+                "count": totals[stage][0],
+                "sum_s": round(totals[stage][1], 6),
+            }
+        return {"time": time.time(), "fps": round(fps, 2), "counters": counters, "stages": stages}
+
+    def prometheus_text(self):
+        snap = self.snapshot()
+        lines = [
+            "# TYPE face_stage_latency_seconds summary",
+        ]
+        for stage, values in snap["stages"].items():
+            for quantile, key in (("0.5", "p50_ms"), ("0.95", "p95_ms"), ("0.99", "p99_ms")):
+                lines.append(
+                    f'face_stage_latency_seconds{{stage="{stage}",quantile="{quantile}"}} {values[key] / 1000.0}'
+                )
+            lines.append(f'face_stage_latency_seconds_sum{{stage="{stage}"}} {values["sum_s"]}')
+            lines.append(f'face_stage_latency_seconds_count{{stage="{stage}"}} {values["count"]}')
+        lines.append("# TYPE face_fps gauge")
+        lines.append(f"face_fps {snap['fps']}")
+        for name, value in sorted(snap["counters"].items()):
+            lines.append(f"# TYPE face_{name}_total counter")
+            lines.append(f"face_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def overlay_lines(self):
+        snap = self.snapshot()
+        counters = snap["counters"]
+        lines = [f"FPS {snap['fps']:.1f} | frames {counters.get('frames', 0)} | dropped {counters.get('dropped_frames', 0)}"]
+        for stage in METRICS_STAGES:
+            values = snap["stages"].get(stage)
+            if values:
+                lines.append(
+                    f"{stage:<9} p50 {values['p50_ms']:6.1f}  p95 {values['p95_ms']:6.1f}  p99 {values['p99_ms']:6.1f} ms"
+                )
+        return lines
+
+metrics = None
+
+def start_metrics_log(path, stop_event, interval=METRICS_LOG_INTERVAL_SEC):
+    # One JSON snapshot per line every interval seconds
+    def writer():
+        with open(path, "a", encoding="utf-8") as f:
+            while not stop_event.wait(interval):
+                f.write(json.dumps(metrics.snapshot()) + "\n")
+                f.flush()
+    threading.Thread(target=writer, daemon=True).start()
+
+def start_metrics_server(port):
+    # Prometheus-style text exposition on http://127.0.0.1:<port>/metrics
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = metrics.prometheus_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Metrics at http://127.0.0.1:{server.server_address[1]}/metrics")
+    return server
+
+def detect_faces(gray, scale=1.0, cascade=None):
+    # With scale < 1 the cascade scans a shrunken copy and boxes are mapped back
+    # to full-resolution coordinates, so the recognition crop keeps full detail
+    if scale != 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    min_side = max(24, int(round(60 * scale)))
+    faces = (cascade or face_cascade).detectMultiScale(
+        gray,
+        scaleFactor=1.1,
+        minNeighbors=5,
+        minSize=(min_side, min_side)
+    )
+    return [tuple(int(round(v / scale)) for v in box) for box in faces]
+
+class FaceDetector:
+    # Cascade detection with optional downscaling. In ROI mode only the areas
+    # around the previous frame's faces are searched, with a full-frame pass
+    # every refresh_every frames or whenever nothing was found last time.
+    def __init__(self, scale=DETECT_SCALE, roi=False, refresh_every=ROI_REFRESH_FRAMES):
+        self.scale = scale
+        self.roi = roi
+        self.refresh_every = refresh_every
+        self.previous = []
+        self.frames_since_full = 0
+        # A CascadeClassifier is not safe to share between threads, and every
+        # source's detect stage runs on its own thread
+        self.cascade = cv2.CascadeClassifier(CASCADE_PATH)
+
+    def __call__(self, gray):
+        if not self.roi or not self.previous or self.frames_since_full + 1 >= self.refresh_every:
+            faces = detect_faces(gray, self.scale, self.cascade)
+            self.frames_since_full = 0
+        else:
+            faces = self._search_rois(gray)
+            self.frames_since_full += 1
+        self.previous = faces
+        return faces
+
+    def _search_rois(self, gray):
+        height, width = gray.shape[:2]
+        faces = []
+        for x, y, w, h in self.previous:
+            mx, my = int(w * ROI_MARGIN), int(h * ROI_MARGIN)
+            x0, y0 = max(x - mx, 0), max(y - my, 0)
+            x1, y1 = min(x + w + mx, width), min(y + h + my, height)
+            for fx, fy, fw, fh in detect_faces(gray[y0:y1, x0:x1], self.scale, self.cascade):
+                box = (fx + x0, fy + y0, fw, fh)
+                # Neighbouring ROIs can overlap and find the same face twice
+                if all(box_iou(box, other) < 0.5 for other in faces):
+                    faces.append(box)
+        return faces
+
+def box_iou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    inter_w = min(ax + aw, bx + bw) - max(ax, bx)
+    inter_h = min(ay + ah, by + bh) - max(ay, by)
+    if inter_w <= 0 or inter_h <= 0:
+        return 0.0
+    inter = inter_w * inter_h
+    return inter / float(aw * ah + bw * bh - inter)
+
+class FaceTracker:
+    # Runs the cascade every N frames (or as soon as a track is lost) and moves
+    # the boxes in between with sparse Lucas-Kanade optical flow. Detections are
+    # matched to existing tracks by IoU so every face keeps a stable track ID.
+    def __init__(self, detect_every=DETECT_EVERY_N):
+        self.detect_every = detect_every
+        self.tracks = {}
+        self.next_id = 0
+        self.prev_gray = None
+        self.frames_since_detect = 0
+        self.lost = False
+        self.detected = False
+
+    def needs_detection(self):
+        return (
+            self.prev_gray is None
+            or self.lost
+            or self.frames_since_detect + 1 >= self.detect_every
+        )
+
+    def update(self, gray, detector):
+        if self.prev_gray is not None and gray.shape != self.prev_gray.shape:
+            # Optical flow needs two frames of one size (image folders can mix
+            # sizes), so old tracks can't be followed: start over from a detection
+            self.tracks = {}
+            self.prev_gray = None
+        self.detected = self.needs_detection()
+        if self.detected:
+            self._match(gray, detector(gray))
+            self.frames_since_detect = 0
+            self.lost = False
+        else:
+            self._propagate(gray)
+            self.frames_since_detect += 1
+        self.prev_gray = gray
+        return [(track_id, track["box"]) for track_id, track in self.tracks.items()]
+
+    def _features(self, gray, box):
+        x, y, w, h = box
+        points = cv2.goodFeaturesToTrack(
+            gray[y:y + h, x:x + w], maxCorners=40, qualityLevel=0.01, minDistance=5
+        )
+        if points is None:
+            return None
+        return points + np.array([x, y], dtype=np.float32)
+
+    def _match(self, gray, detections):
+        pairs = sorted(
+            (
+                (box_iou(track["box"], box), track_id, i)
+                for track_id, track in self.tracks.items()
+                for i, box in enumerate(detections)
+            ),
+            reverse=True,
+        )
+        tracks = {}
+        used = set()
+        for iou, track_id, i in pairs:
+            if iou < TRACK_IOU_THRESHOLD:
+                break
+            if track_id in tracks or i in used:
+                continue
+            tracks[track_id] = {"box": detections[i], "points": self._features(gray, detections[i])}
+            used.add(i)
+
+        # Unmatched detections start new tracks; unmatched tracks are dropped
+        for i, box in enumerate(detections):
+            if i in used:
+                continue
+            tracks[self.next_id] = {"box": box, "points": self._features(gray, box)}
+            self.next_id += 1
+        self.tracks = tracks
+
+    def _propagate(self, gray):
+        height, width = gray.shape[:2]
+        for track_id in list(self.tracks):
+            track = self.tracks[track_id]
+            points = track["points"]
+            if points is None or len(points) < TRACK_MIN_POINTS:
+                del self.tracks[track_id]
+                self.lost = True
+                continue
+
+            moved, status, _err = cv2.calcOpticalFlowPyrLK(
+                self.prev_gray, gray, points, None, winSize=(15, 15), maxLevel=2
+            )
+            good = status.reshape(-1) == 1
+            if good.sum() < TRACK_MIN_POINTS:
+                del self.tracks[track_id]
+                self.lost = True
+                continue
+
+            dx, dy = np.median((moved[good] - points[good]).reshape(-1, 2), axis=0)
+            x, y, w, h = track["box"]
+            x = int(round(min(max(x + dx, 0), width - w)))
+            y = int(round(min(max(y + dy, 0), height - h)))
+            track["box"] = (x, y, w, h)
+            track["points"] = moved[good].reshape(-1, 1, 2)
+
+def needs_prediction(identity, box, frame_index, detected):
+    # Re-predict a track only when it is new, periodically, when its box size
+    # has changed a lot since the last prediction, or when it was last seen as
+    # Unknown and the cascade has just confirmed it again
+    if identity is None:
+        return True
+    if frame_index - identity["frame"] >= RECOGNITION_REFRESH_FRAMES:
+        return True
+    area = box[2] * box[3]
+    if abs(area - identity["area"]) > RECOGNITION_RESIZE_DRIFT * identity["area"]:
+        return True
+    result = identity["result"]
+    return detected and result.done() and result.result()[0] == "Unknown"
+
+calibrated_thresholds = None
+
+def load_thresholds():
+    # {"default": t, "people": {name: t}} written by --calibrate, or None
+    if not os.path.exists(THRESHOLDS_PATH):
+        return None
+    try:
+        with open(THRESHOLDS_PATH, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return {"default": float(data["default"]), "people": {k: float(v) for k, v in data["people"].items()}}
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Ignoring unreadable {THRESHOLDS_PATH} ({e}).")
+        return None
+
+def accept_threshold(name):
+    if calibrated_thresholds is None:
+        return CONFIDENCE_THRESHOLD
+    return calibrated_thresholds["people"].get(name, calibrated_thresholds["default"])
+
+def label_face(names, label_id, confidence):
+    name = names.get(label_id, "Unknown")
+    return name if confidence <= accept_threshold(name) else "Unknown"
+
+thread_buffers = threading.local()
+
+def face_buffers(count):
+    # Per-thread preallocated FACE_SIZE crops, grown on demand, for the predict hot path
+    faces = getattr(thread_buffers, "faces", None)
+    if faces is None or len(faces) < count:
+        faces = thread_buffers.faces = np.empty((max(count, 4),) + FACE_SIZE[::-1], dtype=np.uint8)
+    return faces[:count]
+
+def normalize_face(gray_crop, out=None):
+    face = cv2.resize(gray_crop, FACE_SIZE, dst=out)
+    if equalize_faces:
+        cv2.equalizeHist(face, dst=face)
+    return face
+
+def recognize_face(gray, box):
+    x, y, w, h = box
+    face_gray = normalize_face(gray[y:y + h, x:x + w], face_buffers(1)[0])
+    model, names = active_model
+    started = time.perf_counter()
+    with model_lock.reading():
+        label_id, confidence = model.predict(face_gray)
+    if metrics is not None:
+        metrics.observe("predict", time.perf_counter() - started)
+    return label_face(names, label_id, confidence), confidence
+
+def lbp_codes(faces, radius=1, neighbors=8):
+    # Same sampling points and float32 bilinear interpolation as OpenCV's elbp()
+    r = radius
+    height, width = faces.shape[1:]
+    src = faces.astype(np.float32)
+    center = src[:, r:height - r, r:width - r]
+    center_u8 = faces[:, r:height - r, r:width - r]
+    codes = np.zeros(center.shape, dtype=np.int32)
+    eps = np.finfo(np.float32).eps
+    t = np.empty_like(center)
+    term = np.empty_like(center)
+
+    for n in range(neighbors):
+        x = np.float32(r * math.cos(2.0 * math.pi * n / neighbors))
+        y = np.float32(-r * math.sin(2.0 * math.pi * n / neighbors))
+        fx, fy = int(np.floor(x)), int(np.floor(y))
+        cx, cy = int(np.ceil(x)), int(np.ceil(y))
+        tx, ty = x - np.float32(fx), y - np.float32(fy)
+        weights = (
+            ((1 - tx) * (1 - ty), fy, fx),
+            (tx * (1 - ty), fy, cx),
+            ((1 - tx) * ty, cy, fx),
+            (tx * ty, cy, cx),
+        )
+        if weights[0][0] == 1 and max(w for w, _dy, _dx in weights[1:]) * 255 < eps:
+            # Axis-aligned neighbour: the interpolation is the pixel itself,
+            # so the float test reduces to an integer >= on the raw bytes
+            bit = faces[:, r + fy:height - r + fy, r + fx:width - r + fx] >= center_u8
+        else:
+            # Accumulate left to right in place, as the C++ expression does
+            np.multiply(src[:, r + fy:height - r + fy, r + fx:width - r + fx], weights[0][0], out=t)
+            for w, dy, dx in weights[1:]:
+                np.multiply(src[:, r + dy:height - r + dy, r + dx:width - r + dx], w, out=term)
+                t += term
+            close = np.abs(t - center) < eps
+            bit = (t > center) | close
+        codes |= bit.astype(np.int32) << n
+    return codes
+
+def lbp_histograms(faces, radius=1, neighbors=8, grid_x=8, grid_y=8):
+    faces = np.asarray(faces)
+    hists = []
+    # A couple of faces at a time keeps the float32 temporaries in cache
+    for i in range(0, len(faces), LBP_CHUNK_FACES):
+        codes = lbp_codes(faces[i:i + LBP_CHUNK_FACES], radius, neighbors)
+        batch, height, width = codes.shape
+        patterns = 1 << neighbors
+        cell_h, cell_w = height // grid_y, width // grid_x
+        cells = grid_x * grid_y
+        codes = codes[:, :cell_h * grid_y, :cell_w * grid_x]
+        codes = codes.reshape(batch, grid_y, cell_h, grid_x, cell_w)
+        codes = codes.transpose(0, 1, 3, 2, 4).reshape(batch, cells, cell_h * cell_w)
+        # One bincount for every cell of every face: offset each cell's codes into its own bin range
+        offsets = np.arange(batch * cells, dtype=np.int64).reshape(batch, cells, 1) * patterns
+        counts = np.bincount((codes + offsets).ravel(), minlength=batch * cells * patterns)
+        hist = counts.reshape(batch, cells * patterns).astype(np.float32)
+        hists.append(hist / np.float32(cell_h * cell_w))
+    return np.vstack(hists)
+
+def chi_square(query, bins, columns, totals, samples=None):
+    # Chi-square (OpenCV's HISTCMP_CHISQR_ALT) from one query to many histograms,
+    # rewritten as 2 * (sum(q) + sum(g) - 4 * sum(q*g / (q+g))) where the last
+    # sum only has terms in the query's non-empty bins. columns is bins-major;
+    # samples optionally restricts the search to some of its columns.
+    count = columns.shape[1] if samples is None else len(samples)
+    shared = np.zeros(count)
+    for start in range(0, len(bins), CHI_SQUARE_BIN_BLOCK):
+        block = bins[start:start + CHI_SQUARE_BIN_BLOCK]
+        q = query[block][:, None]
+        gallery = columns[block] if samples is None else columns[np.ix_(block, samples)]
+        total = gallery + q
+        gallery *= q
+        gallery /= total
+        shared += np.add.reduce(gallery, axis=0, dtype=np.float64)
+    if samples is not None:
+        totals = totals[samples]
+    return 2.0 * (query.sum(dtype=np.float64) + totals - 4.0 * shared)
+
+class ExhaustiveIndex:
+    # Compares the query with every training histogram, exactly like predict()
+    def __init__(self, columns, totals, labels):
+        self.columns = columns
+        self.totals = totals
+
+    def search(self, query, bins):
+        dist = chi_square(query, bins, self.columns, self.totals)
+        best = int(dist.argmin())
+        return best, float(dist[best])
+
+class CentroidIndex:
+    # Ranks people by the distance to their mean histogram, then runs the exact
+    # search only over the samples of the top_k closest people
+    def __init__(self, columns, totals, labels, top_k=CENTROID_TOP_K):
+        self.columns = columns
+        self.totals = totals
+        self.top_k = top_k
+        self.members = [np.flatnonzero(labels == label) for label in np.unique(labels)]
+        self.centroids = np.empty((columns.shape[0], len(self.members)), dtype=np.float32)
+        for i, members in enumerate(self.members):
+            self.centroids[:, i] = columns[:, members].mean(axis=1)
+        self.centroid_totals = self.centroids.sum(axis=0, dtype=np.float64)
+
+    def search(self, query, bins):
+        if len(self.members) <= self.top_k:
+            candidates = None
+        else:
+            dist = chi_square(query, bins, self.centroids, self.centroid_totals)
+            nearest = np.argpartition(dist, self.top_k)[:self.top_k]
+            candidates = np.sort(np.concatenate([self.members[i] for i in nearest]))
+        dist = chi_square(query, bins, self.columns, self.totals, candidates)
+        best = int(dist.argmin())
+        if candidates is not None:
+            return int(candidates[best]), float(dist[best])
+        return best, float(dist[best])
+
+GALLERY_INDEXES = {
+    "exhaustive": ExhaustiveIndex,
+    "centroid": CentroidIndex,
+}
+
+class BatchLBPH:
+    # NumPy version of OpenCV's LBPH predict() for many faces at once. LBP codes
+    # and grid histograms are built for the whole batch, then each face is looked
+    # up in a gallery index over the training histograms.
+    def __init__(self, histograms, labels, radius=1, neighbors=8, grid_x=8, grid_y=8, index="exhaustive"):
+        self.radius = radius
+        self.neighbors = neighbors
+        self.grid_x = grid_x
+        self.grid_y = grid_y
+        histograms = np.asarray(histograms, dtype=np.float32)
+        self.labels = np.asarray(labels).reshape(-1)
+        # Stored bins-major so picking a query's non-empty bins copies whole rows
+        columns = np.ascontiguousarray(histograms.T)
+        totals = histograms.sum(axis=1, dtype=np.float64)
+        self.index = GALLERY_INDEXES[index](columns, totals, self.labels)
+
+    @classmethod
+    def from_model(cls, model, index="exhaustive"):
+        return cls(
+            np.vstack(model.getHistograms()),
+            model.getLabels(),
+            model.getRadius(),
+            model.getNeighbors(),
+            model.getGridX(),
+            model.getGridY(),
+            index=index,
+        )
+
+    def spatial_histograms(self, faces):
+        return lbp_histograms(faces, self.radius, self.neighbors, self.grid_x, self.grid_y)
+
+    def predict(self, faces):
+        results = []
+        for query in self.spatial_histograms(faces):
+            best, distance = self.index.search(query, np.flatnonzero(query))
+            results.append((int(self.labels[best]), max(distance, 0.0)))
+        return results
+
+class BatchSlot:
+    # Looks like a per-face future but reads one entry of a whole-frame batch
+    def __init__(self, future, index):
+        self.future = future
+        self.index = index
+
+    def done(self):
+        return self.future.done()
+
+    def result(self):
+        return self.future.result()[self.index]
+
+batch_model = None
+gallery_index = GALLERY_INDEX
+
+def get_batch_model():
+    # Rebuilt whenever active_model is swapped (retrain or incremental update)
+    global batch_model
+    current = active_model
+    if batch_model is None or batch_model[0] is not current:
+        with model_lock.reading():
+            batch_model = (current, BatchLBPH.from_model(current[0], gallery_index))
+    return batch_model[1], current[1]
+
+def recognize_faces(gray, boxes):
+    if not boxes:
+        return []
+    crops = face_buffers(len(boxes))
+    for crop, (x, y, w, h) in zip(crops, boxes):
+        normalize_face(gray[y:y + h, x:x + w], crop)
+    model, names = get_batch_model()
+    started = time.perf_counter()
+    predictions = model.predict(crops)
+    if metrics is not None:
+        metrics.observe("predict", time.perf_counter() - started)
+    return [(label_face(names, label_id, confidence), confidence) for label_id, confidence in predictions]
+
+def submit_recognition(pool, gray, boxes, batch):
+    if batch:
+        future = pool.submit(recognize_faces, gray, boxes)
+        return [BatchSlot(future, i) for i in range(len(boxes))]
+    return [pool.submit(recognize_face, gray, box) for box in boxes]
+
+def forward(stage_queue, item, live, stop_event):
+    # Live cameras drop stale frames; files wait so every frame is processed
+    if live:
+        stage_queue.put_latest(item)
+        return
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            continue
+    # Stopping: only the end-of-stream marker still matters, and only to a
+    # consumer that is waiting on an empty queue
+    if item is None:
+        try:
+            stage_queue.put_nowait(item)
+        except queue.Full:
+            pass
+
+def take(stage_queue, stop_event):
+    # Blocks for the next item, but gives up with None once the pipeline is
+    # stopping and nothing is left, in case the producer died before it could
+    # send its end-of-stream marker
+    while True:
+        try:
+            return stage_queue.get(timeout=STAGE_POLL_SEC)
+        except queue.Empty:
+            if stop_event.is_set():
+                return None
+
+def grab_stage(source, detect_queue, stop_event):
+    frame_index = 0
+    try:
+        while not stop_event.is_set():
+            started = time.perf_counter()
+            ret, frame = source.read()
+            if not ret:
+                break
+            if metrics is not None:
+                metrics.observe("read", time.perf_counter() - started)
+            forward(detect_queue, (frame_index, time.perf_counter(), frame), source.live, stop_event)
+            frame_index += 1
+    except BaseException:
+        # A failed stage stops the whole pipeline instead of leaving it waiting
+        stop_event.set()
+        raise
+    finally:
+        forward(detect_queue, None, source.live, stop_event)
+
+def detect_stage(detect_queue, render_queue, pool, live, stop_event, detector, tracker, batch, stats):
+    try:
+        detect_frames(detect_queue, render_queue, pool, live, stop_event, detector, tracker, batch, stats)
+    except BaseException:
+        stop_event.set()
+        raise
+    finally:
+        forward(render_queue, None, live, stop_event)
+
+def detect_frames(detect_queue, render_queue, pool, live, stop_event, detector, tracker, batch, stats):
+    identities = {}
+    grays = GrayBuffers()
+    while not stop_event.is_set():
+        item = take(detect_queue, stop_event)
+        if item is None:
+            break
+        frame_index, grabbed_at, frame = item
+
+        started = time.perf_counter()
+        buffer, gray = grays.convert(frame)
+        converted = time.perf_counter()
+
+        if tracker is None:
+            # Detect faces in the frame and recognise every one on the worker pool
+            faces = detector(gray)
+            stats["detections"] += 1
+            track_ids = [None] * len(faces)
+            results = submit_recognition(pool, gray, faces, batch)
+            grays.hold(buffer, results)
+            stats["predictions"] += len(faces)
+        else:
+            tracked = tracker.update(gray, detector)
+            stats["detections"] += tracker.detected
+            faces = [box for _track_id, box in tracked]
+            track_ids = [track_id for track_id, _box in tracked]
+            stale = [
+                (track_id, box) for track_id, box in tracked
+                if needs_prediction(identities.get(track_id), box, frame_index, tracker.detected)
+            ]
+            submitted = submit_recognition(pool, gray, [box for _track_id, box in stale], batch)
+            grays.hold(buffer, submitted)
+            for (track_id, box), result in zip(stale, submitted):
+                identities[track_id] = {"result": result, "frame": frame_index, "area": box[2] * box[3]}
+            stats["predictions"] += len(stale)
+            results = [identities[track_id]["result"] for track_id in track_ids]
+            # Forget identities of tracks that have gone away
+            for track_id in set(identities) - set(track_ids):
+                del identities[track_id]
+
+        if metrics is not None:
+            # "detect" includes tracking and handing the crops to the pool
+            metrics.observe("cvtColor", converted - started)
+            metrics.observe("detect", time.perf_counter() - converted)
+
+        forward(render_queue, (frame_index, grabbed_at, frame, faces, track_ids, results), live, stop_event)
+
+def retrain_model():
+    global active_model
+    print("Retraining recogniser...")
+    recognizer, labels_map = active_model
+    new_labels_map = assign_label_ids(DATA_DIR, labels_map)
+    entries = scan_samples(DATA_DIR, new_labels_map)
+    manifest = load_manifest()
+
+    if manifest is not None and os.path.exists(MODEL_PATH):
+        added, changed, removed = diff_manifest(manifest, entries)
+        # LBPH can only add samples, so edits and deletions need a full retrain
+        if not changed and not removed:
+            if not added:
+                print("Model is already up to date.")
+                return
+            images, labels, loaded = read_samples(DATA_DIR, added)
+            samples = [entry for entry in manifest if not entry.get("failed")] + loaded
+            if not loaded:
+                # Only unreadable files: remember them, leave the model alone
+                save_json(MANIFEST_PATH, {"samples": with_failures(samples, entries)})
+                print(f"No readable new samples ({len(added)} unreadable); model unchanged.")
+                return
+            # update() mutates the live model, so predictions pause just for the delta
+            with model_lock.writing():
+                recognizer.update(images, labels)
+                active_model = (recognizer, new_labels_map)
+            save_model(recognizer, new_labels_map, with_failures(samples, entries))
+            print(f"Incremental update complete ({len(loaded)} new samples).")
+            return
+
+    # Full retrain builds a new model while the old one keeps serving predictions
+    new_recognizer, new_labels_map, loaded = train_full_model(new_labels_map)
+    if new_recognizer is None:
+        print("No training data found; retrain skipped.")
+        return
+    save_model(new_recognizer, new_labels_map, loaded)
+    active_model = (new_recognizer, new_labels_map)
+    print("Retrain complete.")
 
-ui_name = ""
-set_name_requested = False
-capture_enabled = False
-exit_requested = False
-retrain_requested = False
+def start_background_retrain(on_done=None):
+    global retrain_thread
+    if retrain_thread is not None and retrain_thread.is_alive():
+        print("Retrain already running.")
+        return
 
-def gui_thread():
-    global ui_name, set_name_requested, capture_enabled, exit_requested, retrain_requested
+    def run():
+        try:
+            retrain_model()
+        finally:
+            if on_done is not None:
+                on_done()
 
+    retrain_thread = threading.Thread(target=run, daemon=True)
+    retrain_thread.start()
+
+def retrain_running():
+    return retrain_thread is not None and retrain_thread.is_alive()
+
+def sample_rejection(face, crop_side, previous):
+    # Quality gate for captured samples; returns why a sample is rejected, or None
+    if crop_side < SAMPLE_MIN_SIDE:
+        return "too small"
+    if cv2.Laplacian(face, cv2.CV_64F).var() < SAMPLE_MIN_SHARPNESS:
+        return "blurry"
+    # A frontal face is roughly mirror-symmetric; a turned head is not
+    half = FACE_SIZE[0] // 2
+    left = face[:, :half].astype(np.int16)
+    right = cv2.flip(face[:, -half:], 1)
+    if 1.0 - np.abs(left - right).mean() / 255.0 < SAMPLE_MIN_SYMMETRY:
+        return "not frontal"
+    if previous is not None and np.abs(previous - thumbnail(face)).mean() < SAMPLE_DUPLICATE_DIFF:
+        return "near-duplicate"
+    return None
+
+def thumbnail(face):
+    return cv2.resize(face, (32, 32), interpolation=cv2.INTER_AREA).astype(np.int16)
+
+class SampleWriter:
+    # Capture mode hands face crops to this thread so the render loop never
+    # waits on the disk. Samples are normalised the same way training decodes
+    # them, pass the quality gate, are written in batches as the next free
+    # NNN.jpg and go straight into the decoded-face cache.
+    def __init__(self, data_dir=DATA_DIR, target=SAMPLES_PER_PERSON):
+        self.data_dir = data_dir
+        self.target = target
+        self.pending = queue.Queue(SAMPLE_QUEUE_SIZE)
+        self.lock = threading.Lock()
+        self.saved = {}
+        self.next_index = {}
+        self.previous = {}
+        self.rejected = 0
+        self.dropped = 0
+        self.on_saved = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def start_person(self, name):
+        with self.lock:
+            self.saved[name] = 0
+
+    def saved_count(self, name):
+        with self.lock:
+            return self.saved.get(name, 0)
+
+    def submit(self, name, crop):
+        # Never blocks: if the writer is behind, the sample is dropped
+        try:
+            self.pending.put_nowait((name, crop))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self):
+        self.pending.put(None)
+        self.thread.join()
+        # Captured samples not yet picked up by a retrain go to the cache now
+        if face_cache is not None:
+            face_cache.flush()
+
+    def _run(self):
+        closing = False
+        while not closing:
+            batch = [self.pending.get()]
+            while len(batch) < SAMPLE_WRITE_BATCH and not self.pending.empty():
+                batch.append(self.pending.get_nowait())
+            closing = None in batch
+            samples = [item for item in batch if item is not None]
+            if samples:
+                self._write(samples)
+
+    def _write(self, samples):
+        entries = []
+        faces = []
+        label_ids = None
+        for name, crop in samples:
+            if self.saved_count(name) >= self.target:
+                continue
+            gray = crop if crop.ndim == 2 else cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+            face = cv2.resize(gray, FACE_SIZE)
+            reason = sample_rejection(face, min(gray.shape), self.previous.get(name))
+            if reason is not None:
+                self.rejected += 1
+                print(f"Skipped sample for {name}: {reason}")
+                continue
+            self.previous[name] = thumbnail(face)
+            if equalize_faces:
+                face = cv2.equalizeHist(face)
+
+            ok, encoded = cv2.imencode(".jpg", face)
+            if not ok:
+                continue
+            filename = f"{self._next_index(name):03d}.jpg"
+            filepath = os.path.join(self.data_dir, name, filename)
+            with open(filepath, "wb") as f:
+                f.write(encoded.tobytes())
+            with self.lock:
+                self.saved[name] = self.saved.get(name, 0) + 1
+                count = self.saved[name]
+            print(f"Saved {filepath}")
+            if self.on_saved is not None:
+                self.on_saved(name, count)
+
+            if label_ids is None:
+                label_ids = {person: label_id for label_id, person in assign_label_ids(self.data_dir, active_model[1]).items()}
+            stat = os.stat(filepath)
+            entries.append({
+                "path": f"{name}/{filename}",
+                "mtime": stat.st_mtime,
+                "size": stat.st_size,
+                "label": label_ids.get(name, -1),
+            })
+            # Cache what training would decode from the JPEG, not the pre-encoding face
+            faces.append(cv2.imdecode(encoded, cv2.IMREAD_GRAYSCALE))
+
+        # The training manifest is left alone so the next retrain still sees
+        # these files as new, but it gets their pixels from the cache
+        if entries and self.data_dir == DATA_DIR:
+            get_face_cache().add(entries, faces)
+
+    def _next_index(self, name):
+        # Continue after the highest NNN.jpg so earlier samples are never overwritten
+        if name not in self.next_index:
+            person_dir = os.path.join(self.data_dir, name)
+            os.makedirs(person_dir, exist_ok=True)
+            stems = [os.path.splitext(f)[0] for f in os.listdir(person_dir)]
+            self.next_index[name] = max((int(stem) + 1 for stem in stems if stem.isdigit()), default=0)
+        index = self.next_index[name]
+        self.next_index[name] += 1
+        return index
+
+equalize_faces = EQUALIZE_FACES
+
+class RecognizerService:
+    # One recognition pool, over the one in-memory model, shared by every
+    # source. Each source gets a client that may only have a few recognitions
+    # queued, so a busy or slow source waits on its own limit instead of
+    # filling the pool ahead of the others.
+    def __init__(self, workers=RECOGNITION_WORKERS, per_source=RECOGNITION_INFLIGHT_PER_SOURCE):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.per_source = per_source
+
+    def client(self):
+        return RecognizerClient(self.pool, self.per_source)
+
+    def shutdown(self):
+        self.pool.shutdown(wait=True)
+
+class RecognizerClient:
+    # Looks like an executor to detect_stage
+    def __init__(self, pool, limit):
+        self.pool = pool
+        self.slots = threading.BoundedSemaphore(limit)
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(lambda _future: self.slots.release())
+        return future
+
+class DisplayBoard:
+    # With several sources the render stages run on their own threads; they
+    # post frames here and the main thread owns imshow/waitKey for all windows
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = {}
+        self.updated = threading.Event()
+        self.key = -1
+
+    def post(self, window, frame):
+        with self.lock:
+            self.frames[window] = frame
+        self.updated.set()
+        return self.key
+
+    def pump(self):
+        self.updated.wait(0.05)
+        self.updated.clear()
+        with self.lock:
+            frames, self.frames = self.frames, {}
+        for window, frame in frames.items():
+            cv2.imshow(window, frame)
+        self.key = cv2.waitKey(1) & 0xFF
+        return self.key
+
+# ---- Face engine: the pipeline driven by commands, reporting status events ----
+class FaceEngine:
+    # Opens nothing until run(), so the GUI, the headless CLI and scripts can
+    # all import and drive it. Commands arrive through send() and are applied
+    # between frames; status changes are pushed to subscribe() listeners.
+    def __init__(
+        self,
+        detector=None,
+        tracker=None,
+        batch=False,
+        workers=RECOGNITION_WORKERS,
+        writer=None,
+        name=None,
+    ):
+        self.detector = detector if detector is not None else FaceDetector()
+        self.tracker = tracker
+        self.batch = batch
+        self.workers = workers
+        self.writer = writer
+        # Set when several sources run side by side; labels windows and metrics
+        self.name = name
+        self.window = "Live Camera" if name is None else f"Live Camera ({name})"
+        if writer is not None:
+            writer.on_saved = lambda name, count: self.send("saved", name, count)
+        self.commands = queue.Queue()
+        self.listeners = []
+        self.render_queue = None
+        self.current_name = None
+        self.saved_count = 0
+        self.capture_enabled = False
+        self.last_save_time = 0.0
+        self.stop_requested = False
+
+    def send(self, command, *args):
+        # Commands: set_name(name), capture(on), retrain(), quit(), saved(name, count)
+        self.commands.put((command, args))
+        if command == "quit" and self.render_queue is not None:
+            # Wake a render loop that is waiting for its next frame
+            self.render_queue.put_latest(None)
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+        listener(self.status())
+
+    def status(self):
+        return {
+            "capture": self.capture_enabled,
+            "name": self.current_name,
+            "saved": self.saved_count,
+            "retraining": retrain_running(),
+        }
+
+    def publish(self):
+        status = self.status()
+        for listener in self.listeners:
+            listener(status)
+
+    def handle_commands(self):
+        if self.commands.empty():
+            return
+        while not self.commands.empty():
+            command, args = self.commands.get_nowait()
+            if command == "quit":
+                self.stop_requested = True
+            elif command == "capture":
+                self.capture_enabled = args[0]
+            elif command == "set_name":
+                if self.writer is None:
+                    continue
+                self.current_name = args[0]
+                self.saved_count = 0
+                self.writer.start_person(self.current_name)
+                print(f"Now capturing samples for {self.current_name}")
+            elif command == "retrain":
+                # Training runs in the background and reports back when done
+                start_background_retrain(on_done=self.publish)
+            elif command == "saved":
+                name, count = args
+                if name != self.current_name:
+                    continue
+                self.saved_count = count
+                if count >= SAMPLES_PER_PERSON:
+                    print(f"Done capturing samples for {name}")
+                    self.current_name = None
+        self.publish()
+
+    def capture_sample(self, frame, faces):
+        if not (self.capture_enabled and self.current_name and len(faces) > 0):
+            return
+        now = time.time()
+        if now - self.last_save_time >= CAPTURE_DELAY_SEC:
+            # Queue the biggest detected face; the writer thread saves it
+            (x, y, w, h) = max(faces, key=lambda f: f[2] * f[3])
+            if self.writer.submit(self.current_name, frame[y:y + h, x:x + w].copy()):
+                self.last_save_time = now
+
+    def render_stage(self, render_queue, stop_event, headless, max_frames, board=None):
+        rendered = 0
+        latency_total = 0.0
+        overlay = []
+        overlay_at = 0.0
+        while True:
+            self.handle_commands()
+            if self.stop_requested:
+                break
+            item = take(render_queue, stop_event)
+            if item is None:
+                break
+            frame_index, grabbed_at, frame, faces, track_ids, results = item
+            names = [result.result()[0] for result in results]
+            started = time.perf_counter()
+            if not headless:
+                # Before anything is drawn: boxes and text in the crop would
+                # pass the blur gate and end up in the dataset
+                self.capture_sample(frame, faces)
+
+            # Draw name + box for each recognised face
+            for (x, y, w, h), track_id, name in zip(faces, track_ids, names):
+                if headless:
+                    continue
+                if track_id is not None:
+                    name = f"{name} #{track_id}"
+
+                # Draw green box
+                cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
+
+                # Draw name above the box
+                cv2.putText(
+                    frame,
+                    name,
+                    (x, y - 10),
+                    cv2.FONT_HERSHEY_SIMPLEX,
+                    0.7,
+                    (0, 255, 0),
+                    2
+                )
+
+            rendered += 1
+            latency_total += time.perf_counter() - grabbed_at
+            if metrics is not None:
+                metrics.observe("latency", time.perf_counter() - grabbed_at)
+                metrics.frame_done()
+            if max_frames and rendered >= max_frames:
+                break
+
+            if headless:
+                continue
+
+            status = "Use GUI to set name and capture"
+            if self.current_name:
+                status = f"Name: {self.current_name} | Saved: {self.saved_count}/{SAMPLES_PER_PERSON}"
+
+            cv2.putText(
+                frame,
+                status,
+                (10, 30),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.7,
+                (0, 255, 0),
+                2
+            )
+
+            if metrics is not None:
+                # Percentiles are recomputed about once a second, not every frame
+                if started - overlay_at >= METRICS_OVERLAY_REFRESH_SEC:
+                    overlay = metrics.overlay_lines()
+                    overlay_at = started
+                for i, line in enumerate(overlay):
+                    cv2.putText(frame, line, (10, 60 + 20 * i), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 255), 1)
+                drawn = time.perf_counter()
+                metrics.observe("draw", drawn - started)
+
+            if board is None:
+                cv2.imshow(self.window, frame)
+                # Press 'q' to quit the window.
+                key = cv2.waitKey(1) & 0xFF
+            else:
+                key = board.post(self.window, frame)
+
+            if metrics is not None:
+                metrics.observe("display", time.perf_counter() - drawn)
+
+            if key == ord("q"):
+                break
+        return rendered, latency_total
+
+    def run(self, source, headless=False, max_frames=0, service=None, board=None):
+        # service: a RecognizerService shared with other engines (else one of our own)
+        # board: DisplayBoard when the calling thread is not the one that may call imshow
+        detect_queue = DropOldestQueue(DETECT_QUEUE_SIZE)
+        render_queue = DropOldestQueue(RENDER_QUEUE_SIZE)
+        stop_event = threading.Event()
+        stats = {"detections": 0, "predictions": 0}
+        if metrics is not None:
+            suffix = "" if self.name is None else f"_{self.name}"
+            metrics.gauge("dropped_frames" + suffix, lambda: detect_queue.dropped + render_queue.dropped)
+            metrics.gauge("cascade_runs" + suffix, lambda: stats["detections"])
+            metrics.gauge("predictions" + suffix, lambda: stats["predictions"])
+
+        self.stop_requested = False
+        self.render_queue = render_queue
+        own_service = service is None
+        if own_service:
+            service = RecognizerService(self.workers)
+        pool = service.client()
+        try:
+            stages = [
+                threading.Thread(target=grab_stage, args=(source, detect_queue, stop_event), daemon=True),
+                threading.Thread(
+                    target=detect_stage,
+                    args=(
+                        detect_queue, render_queue, pool, source.live, stop_event,
+                        self.detector, self.tracker, self.batch, stats,
+                    ),
+                    daemon=True,
+                ),
+            ]
+            started = time.perf_counter()
+            for stage in stages:
+                stage.start()
+
+            # Rendering stays on the calling thread because imshow/waitKey need the main thread
+            try:
+                rendered, latency_total = self.render_stage(render_queue, stop_event, headless, max_frames, board)
+            finally:
+                stop_event.set()
+            elapsed = time.perf_counter() - started
+            for stage in stages:
+                stage.join(timeout=1.0)
+        finally:
+            if own_service:
+                service.shutdown()
+        self.render_queue = None
+
+        return {
+            "source": self.name,
+            "frames": rendered,
+            "seconds": elapsed,
+            "fps": rendered / elapsed if elapsed > 0 else 0.0,
+            "avg_latency_ms": 1000.0 * latency_total / rendered if rendered else 0.0,
+            "dropped": detect_queue.dropped + render_queue.dropped,
+            "detections": stats["detections"],
+            "predictions": stats["predictions"],
+        }
+
+def run_sources(engines, sources, headless=False, max_frames=0, workers=RECOGNITION_WORKERS):
+    # Every source gets its own engine (grab, detect and render threads) and
+    # they all share one RecognizerService. Quitting any of them stops all.
+    board = None if headless else DisplayBoard()
+    summaries = [None] * len(engines)
+    service = RecognizerService(workers)
+
+    def run(i):
+        summaries[i] = engines[i].run(sources[i], headless, max_frames, service, board)
+
+    threads = [threading.Thread(target=run, args=(i,), daemon=True) for i in range(len(engines))]
+    try:
+        for thread in threads:
+            thread.start()
+        stopping = False
+        while any(thread.is_alive() for thread in threads):
+            if board is not None:
+                key = board.pump()
+            else:
+                time.sleep(0.1)
+                key = -1
+            if not stopping and (key == ord("q") or any(engine.stop_requested for engine in engines)):
+                stopping = True
+                for engine in engines:
+                    engine.send("quit")
+    finally:
+        service.shutdown()
+    return summaries
+
+def print_run_summary(summary):
+    if summary["source"] is not None:
+        print(f"[{summary['source']}]", end=" ")
+    print(
+        f"Processed {summary['frames']} frames in {summary['seconds']:.2f}s "
+        f"({summary['fps']:.1f} fps, avg latency {summary['avg_latency_ms']:.1f} ms, dropped {summary['dropped']})"
+    )
+    print(f"Cascade runs: {summary['detections']} | Face predictions: {summary['predictions']}")
+
+# ---- Simple GUI for name entry and capture control ----
+def gui_thread(engine):
     root = tk.Tk()
     root.title("Face Capture Controls")
     root.geometry("380x230")
@@ -113,23 +1896,18 @@ def gui_thread():
     name_entry.pack(pady=5)
 
     def on_set_name():
-        global ui_name, set_name_requested
         name = name_entry.get().strip()
         if name:
-            ui_name = name
-            set_name_requested = True
+            engine.send("set_name", name)
 
     def on_start():
-        global capture_enabled
-        capture_enabled = True
+        engine.send("capture", True)
 
     def on_stop():
-        global capture_enabled
-        capture_enabled = False
+        engine.send("capture", False)
 
     def on_quit():
-        global exit_requested
-        exit_requested = True
+        engine.send("quit")
         root.quit()
 
     btn_frame = tk.Frame(root)
@@ -139,8 +1917,7 @@ def gui_thread():
     tk.Button(btn_frame, text="Stop Capture", width=12, command=on_stop).grid(row=0, column=2, padx=5)
 
     def on_retrain():
-        global retrain_requested
-        retrain_requested = True
+        engine.send("retrain")
 
     status_var = tk.StringVar(value="Status: Idle")
     tk.Label(root, textvariable=status_var).pack(pady=(5, 0))
@@ -148,128 +1925,936 @@ def gui_thread():
     tk.Button(root, text="Retrain", width=10, command=on_retrain).pack(pady=(5, 0))
     tk.Button(root, text="Quit", width=10, command=on_quit).pack(pady=(5, 0))
 
-    def update_status():
-        if exit_requested:
+    # The engine pushes status from its own threads; only the Tk thread reads
+    # it, on a timer, so no other thread ever calls into Tcl (a call that lands
+    # while mainloop is exiting would block that thread for good)
+    statuses = queue.Queue()
+
+    def show_status():
+        root.after(STATUS_POLL_MS, show_status)
+        status = None
+        while not statuses.empty():
+            status = statuses.get_nowait()
+        if status is None:
             return
-        capture_state = "ON" if capture_enabled else "OFF"
-        name_state = current_name if current_name else "None"
-        status_var.set(f"Status: Capture {capture_state} | Name: {name_state} | Saved: {saved_count}")
-        root.after(200, update_status)
+        capture_state = "ON" if status["capture"] else "OFF"
+        name_state = status["name"] if status["name"] else "None"
+        text = f"Status: Capture {capture_state} | Name: {name_state} | Saved: {status['saved']}"
+        if status["retraining"]:
+            text += " | Retraining..."
+        status_var.set(text)
 
-    update_status()
+    engine.subscribe(statuses.put)
+    show_status()
 
     root.mainloop()
 
-threading.Thread(target=gui_thread, daemon=True).start()
+frame_ring = None
 
-while True:
-    if exit_requested:
-        break
+def init_offline_worker(detect_scale, batch, index, equalize, ring_spec, thresholds):
+    # Each worker process reads the saved model once and keeps it for every chunk
+    global active_model, gallery_index, equalize_faces, offline_settings, frame_ring, calibrated_thresholds
+    active_model = read_model()
+    calibrated_thresholds = thresholds
+    gallery_index = index
+    equalize_faces = equalize
+    offline_settings = (detect_scale, batch)
+    if ring_spec is not None:
+        frame_ring = FrameRing.attach(ring_spec)
 
-    ret, frame = cap.read()
-    if not ret:
-        print("Failed to read a frame from the camera.")
-        break
+def process_offline_chunk(start, items):
+    detect_scale, batch = offline_settings
+    records = []
+    for offset, item in enumerate(items):
+        record = {"frame": start + offset}
+        if isinstance(item, str):
+            # Image folders: workers decode the files themselves
+            record["path"] = item
+            gray = cv2.imread(item, cv2.IMREAD_GRAYSCALE)
+            if gray is None:
+                record["error"] = "unreadable image"
+                records.append(record)
+                continue
+        else:
+            # Video frames: a view of the grey frame the reader left in shared memory
+            gray = frame_ring.view(*item)
+            if gray is None:
+                record["error"] = "frame overwritten before it was processed"
+                records.append(record)
+                continue
 
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        boxes = detect_faces(gray, detect_scale)
+        if batch:
+            results = recognize_faces(gray, boxes)
+        else:
+            results = [recognize_face(gray, box) for box in boxes]
+        if not isinstance(item, str) and not frame_ring.release(*item):
+            record["error"] = "frame overwritten while it was processed"
+            records.append(record)
+            continue
+        record["faces"] = [
+            {"box": list(box), "label": name, "confidence": round(float(confidence), 3)}
+            for box, (name, confidence) in zip(boxes, results)
+        ]
+        records.append(record)
+    return records
 
-    # Detect faces in the frame
-    faces = face_cascade.detectMultiScale(
-        gray,
-        scaleFactor=1.1,
-        minNeighbors=5,
-        minSize=(60, 60)
+def offline_chunks(source, ring=None, frame=None):
+    if source.frame_paths is not None:
+        for start in range(0, len(source.frame_paths), OFFLINE_CHUNK_FRAMES):
+            yield start, source.frame_paths[start:start + OFFLINE_CHUNK_FRAMES]
+        return
+
+    # Video files are decoded here straight into grey ring slots; workers
+    # only receive (slot, seq) pairs
+    start = 0
+    chunk = []
+    while True:
+        if frame is None:
+            ret, frame = source.read()
+            if not ret:
+                break
+        slot, seq = ring.acquire(overwrite=source.live)
+        if frame.shape[:2] != ring.shape:
+            frame = cv2.resize(frame, ring.shape[::-1])
+        cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=ring.frames[slot])
+        chunk.append((slot, seq))
+        frame = None
+        if len(chunk) == OFFLINE_CHUNK_FRAMES:
+            yield start, chunk
+            start += len(chunk)
+            chunk = []
+    if chunk:
+        yield start, chunk
+
+def run_offline(source, out_path, procs, detect_scale=DETECT_SCALE, batch=False):
+    # Headless reprocessing of recorded footage: frames are spread over a process
+    # pool in chunks and one JSON line per frame is written, in frame order
+    log = sys.stderr if out_path == "-" else sys.stdout
+    out = sys.stdout if out_path == "-" else open(out_path, "w", encoding="utf-8")
+    frames = faces = 0
+    started = time.perf_counter()
+    ring = first = None
+    if source.frame_paths is None:
+        ret, first = source.read()
+        if ret:
+            # Enough slots for every chunk in flight plus the one being filled
+            ring = FrameRing(OFFLINE_CHUNK_FRAMES * (2 * procs + 1), first.shape[:2])
+    try:
+        with ProcessPoolExecutor(
+            max_workers=procs,
+            initializer=init_offline_worker,
+            initargs=(
+                detect_scale, batch, gallery_index, equalize_faces,
+                ring.spec() if ring else None, calibrated_thresholds,
+            ),
+        ) as pool:
+            pending = deque()
+
+            def write_next():
+                nonlocal frames, faces
+                for record in pending.popleft().result():
+                    out.write(json.dumps(record) + "\n")
+                    frames += 1
+                    faces += len(record.get("faces", []))
+
+            for start, items in offline_chunks(source, ring, first):
+                pending.append(pool.submit(process_offline_chunk, start, items))
+                # Bounded read-ahead keeps memory flat on long recordings
+                if len(pending) >= 2 * procs:
+                    write_next()
+            while pending:
+                write_next()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if ring is not None:
+            ring.close()
+
+    elapsed = time.perf_counter() - started
+    fps = frames / elapsed if elapsed > 0 else 0.0
+    print(
+        f"Processed {frames} frames ({faces} faces) in {elapsed:.2f}s "
+        f"with {procs} processes: {fps:.1f} fps",
+        file=log,
     )
 
-    # Recognize each detected face and draw name + box
-    for (x, y, w, h) in faces:
-        face_gray = gray[y:y + h, x:x + w]
-        face_gray = cv2.resize(face_gray, (200, 200))
+def compare_detection_modes(clip_path, scale):
+    # Accuracy/throughput report: full-resolution detection against downscaled
+    # and ROI detection, on the enrolled stills and on a recorded clip
+    modes = [
+        ("full", 1.0, False),
+        (f"scale {scale:g}", scale, False),
+        ("roi", 1.0, True),
+        (f"scale {scale:g} + roi", scale, True),
+    ]
 
-        label_id, confidence = recognizer.predict(face_gray)
-        if confidence <= CONFIDENCE_THRESHOLD:
-            name = labels_map.get(label_id, "Unknown")
-        else:
-            name = "Unknown"
-
-        # Draw green box
-        cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-
-        # Draw name above the box
-        cv2.putText(
-            frame,
-            name,
-            (x, y - 10),
-            cv2.FONT_HERSHEY_SIMPLEX,
-            0.7,
-            (0, 255, 0),
-            2
+    stills = []
+    for person in sorted(os.listdir(DATA_DIR)):
+        person_dir = os.path.join(DATA_DIR, person)
+        if not os.path.isdir(person_dir):
+            continue
+        for filename in sorted(os.listdir(person_dir)):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                img = cv2.imread(os.path.join(person_dir, filename), cv2.IMREAD_GRAYSCALE)
+                if img is not None:
+                    stills.append((person, img))
+
+    print(f"Stills from {DATA_DIR} ({len(stills)} images, each one detected on its own)")
+    print(f"{'mode':<18}{'detected':>10}{'correct':>10}{'ms/img':>10}")
+    for mode, mode_scale, roi in modes:
+        if roi:
+            continue
+        detected = correct = 0
+        started = time.perf_counter()
+        for person, img in stills:
+            faces = detect_faces(img, mode_scale)
+            if not faces:
+                continue
+            detected += 1
+            name, _confidence = recognize_face(img, max(faces, key=lambda f: f[2] * f[3]))
+            correct += name == person
+        elapsed_ms = 1000.0 * (time.perf_counter() - started) / max(len(stills), 1)
+        print(
+            f"{mode:<18}{detected / len(stills):>10.1%}{correct / len(stills):>10.1%}{elapsed_ms:>10.2f}"
+        )
+
+    if not clip_path:
+        return
+    source = FrameSource(clip_path)
+    frames = []
+    while True:
+        ret, frame = source.read()
+        if not ret:
+            break
+        frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    source.release()
+    if not frames:
+        print(f"No frames could be read from {clip_path}")
+        return
+
+    print()
+    print(f"Clip {clip_path} ({len(frames)} frames, recall measured against full-resolution boxes)")
+    print(f"{'mode':<18}{'fps':>10}{'recall':>10}{'faces/frm':>10}")
+    reference = None
+    for mode, mode_scale, roi in modes:
+        detector = FaceDetector(mode_scale, roi)
+        boxes = []
+        started = time.perf_counter()
+        for gray in frames:
+            faces = detector(gray)
+            for box in faces:
+                recognize_face(gray, box)
+            boxes.append(faces)
+        fps = len(frames) / (time.perf_counter() - started)
+        if reference is None:
+            reference = boxes
+        expected = sum(len(faces) for faces in reference)
+        found = sum(
+            1
+            for ref_faces, faces in zip(reference, boxes)
+            for ref in ref_faces
+            if any(box_iou(ref, box) >= 0.5 for box in faces)
+        )
+        recall = found / expected if expected else 1.0
+        print(f"{mode:<18}{fps:>10.1f}{recall:>10.1%}{sum(map(len, boxes)) / len(frames):>10.2f}")
+
+def benchmark_batch_recognition(repeats=20):
+    # Per-face recognizer.predict loop against one BatchLBPH call per frame
+    model, _names = active_model
+    batch_model, _names = get_batch_model()
+    samples = []
+    for person in sorted(os.listdir(DATA_DIR)):
+        person_dir = os.path.join(DATA_DIR, person)
+        if not os.path.isdir(person_dir):
+            continue
+        for filename in sorted(os.listdir(person_dir)):
+            img = cv2.imread(os.path.join(person_dir, filename), cv2.IMREAD_GRAYSCALE)
+            if img is not None:
+                samples.append(cv2.resize(img, FACE_SIZE))
+    if not samples:
+        print(f"No face images found in {DATA_DIR}")
+        return
+
+    print(f"Gallery: {len(batch_model.labels)} training histograms")
+    print(f"{'faces':>6}{'loop ms':>10}{'batch ms':>10}{'speedup':>9}{'labels':>8}{'max |d|':>10}")
+    for count in BENCH_FACE_COUNTS:
+        faces = np.stack([samples[i % len(samples)] for i in range(count)])
+
+        started = time.perf_counter()
+        for _ in range(repeats):
+            expected = [model.predict(face) for face in faces]
+        loop_ms = 1000.0 * (time.perf_counter() - started) / repeats
+
+        started = time.perf_counter()
+        for _ in range(repeats):
+            got = batch_model.predict(faces)
+        batch_ms = 1000.0 * (time.perf_counter() - started) / repeats
+
+        same = sum(a[0] == b[0] for a, b in zip(expected, got))
+        max_diff = max(abs(a[1] - b[1]) for a, b in zip(expected, got))
+        print(
+            f"{count:>6}{loop_ms:>10.2f}{batch_ms:>10.2f}{loop_ms / batch_ms:>8.2f}x"
+            f"{same:>5}/{count:<2}{max_diff:>10.2e}"
         )
 
-    status = "Use GUI to set name and capture"
-    if current_name:
-        status = f"Name: {current_name} | Saved: {saved_count}/{SAMPLES_PER_PERSON}"
-
-    cv2.putText(
-        frame,
-        status,
-        (10, 30),
-        cv2.FONT_HERSHEY_SIMPLEX,
-        0.7,
-        (0, 255, 0),
-        2
+def synthetic_person(base, rng):
+    # A synthetic identity: one data/ face under its own fixed warp and gamma
+    angle = rng.uniform(-15, 15)
+    scale = rng.uniform(0.9, 1.1)
+    matrix = cv2.getRotationMatrix2D((FACE_SIZE[0] / 2, FACE_SIZE[1] / 2), angle, scale)
+    matrix[:, 2] += rng.uniform(-8, 8, size=2)
+    face = cv2.warpAffine(base, matrix, FACE_SIZE, borderMode=cv2.BORDER_REFLECT)
+    if rng.random() < 0.5:
+        face = cv2.flip(face, 1)
+    gamma = rng.uniform(0.7, 1.4)
+    return (255.0 * (face / 255.0) ** gamma).astype(np.uint8)
+
+def synthetic_sample(person, rng):
+    # One capture of a synthetic identity: small pose, brightness and noise jitter
+    matrix = cv2.getRotationMatrix2D((FACE_SIZE[0] / 2, FACE_SIZE[1] / 2), rng.uniform(-2, 2), 1.0)
+    matrix[:, 2] += rng.uniform(-2, 2, size=2)
+    face = cv2.warpAffine(person, matrix, FACE_SIZE, borderMode=cv2.BORDER_REFLECT).astype(np.float32)
+    face += rng.uniform(-10, 10) + rng.normal(0, 4, size=face.shape)
+    return np.clip(face, 0, 255).astype(np.uint8)
+
+def benchmark_gallery_index():
+    # Recall/latency of the centroid index against exhaustive search on
+    # synthetic galleries grown from the data/ faces
+    rng = np.random.default_rng(0)
+    faces, _labels, _loaded = read_samples(DATA_DIR, scan_samples(DATA_DIR, assign_label_ids(DATA_DIR, {})))
+    bases = [np.asarray(face) for face in faces]
+    if not bases:
+        print(f"No face images found in {DATA_DIR}")
+        return
+
+    print(f"{'people':>7}{'samples':>9}{'index':>15}{'ms/query':>10}{'recall':>9}{'label acc':>11}")
+    for people in BENCH_GALLERY_PEOPLE:
+        persons = [synthetic_person(bases[i % len(bases)], rng) for i in range(people)]
+        histograms = []
+        labels = []
+        for label, person in enumerate(persons):
+            faces = np.stack([synthetic_sample(person, rng) for _ in range(BENCH_GALLERY_SAMPLES)])
+            histograms.append(lbp_histograms(faces))
+            labels.extend([label] * BENCH_GALLERY_SAMPLES)
+        histograms = np.vstack(histograms)
+        labels = np.array(labels)
+        truth = rng.integers(0, people, size=BENCH_QUERIES)
+        queries = lbp_histograms(np.stack([synthetic_sample(persons[i], rng) for i in truth]))
+        del persons
+
+        exhaustive = BatchLBPH(histograms, labels, index="exhaustive")
+        modes = [("exhaustive", exhaustive.index)]
+        for top_k in BENCH_TOP_K:
+            modes.append((f"centroid k={top_k}", CentroidIndex(exhaustive.index.columns, exhaustive.index.totals, labels, top_k)))
+
+        reference = None
+        for name, index in modes:
+            started = time.perf_counter()
+            found = [index.search(query, np.flatnonzero(query))[0] for query in queries]
+            ms = 1000.0 * (time.perf_counter() - started) / len(queries)
+            if reference is None:
+                reference = found
+            recall = np.mean([a == b for a, b in zip(found, reference)])
+            accuracy = np.mean(labels[found] == truth)
+            print(f"{people:>7}{len(labels):>9}{name:>15}{ms:>10.2f}{recall:>9.1%}{accuracy:>11.1%}")
+
+class ReplaySource:
+    # In-memory frames played back like a video file, so every frame is processed
+    live = False
+
+    def __init__(self, frames):
+        self.frames = frames
+        self.position = 0
+
+    def is_opened(self):
+        return True
+
+    def read(self):
+        if self.position >= len(self.frames):
+            return False, None
+        frame = self.frames[self.position].copy()
+        self.position += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+def bench_background(rng, kind):
+    width, height = BENCH_FRAME_SIZE
+    if kind == 0:
+        # Flat colour
+        return np.full((height, width, 3), rng.integers(0, 256, size=3), dtype=np.uint8)
+    if kind == 1:
+        # Horizontal gradient between two colours
+        start, end = rng.integers(0, 256, size=(2, 3))
+        t = np.linspace(0.0, 1.0, width)[None, :, None]
+        return np.broadcast_to(start * (1 - t) + end * t, (height, width, 3)).astype(np.uint8)
+    if kind == 2:
+        # Smooth noise texture
+        noise = rng.integers(0, 256, size=(height // 8, width // 8, 3), dtype=np.uint8)
+        return cv2.resize(noise, (width, height), interpolation=cv2.INTER_CUBIC)
+    # Cluttered room: grey wall with random boxes
+    background = np.full((height, width, 3), 128, dtype=np.uint8)
+    for _ in range(12):
+        x, y = int(rng.integers(0, width)), int(rng.integers(0, height))
+        w, h = int(rng.integers(20, 200)), int(rng.integers(20, 200))
+        cv2.rectangle(background, (x, y), (x + w, y + h), rng.integers(0, 256, size=3).tolist(), -1)
+    return background
+
+def build_bench_fixture(seed=BENCH_SEED):
+    # Deterministic clip: the odd-numbered data/ crops of each BENCH_PEOPLE
+    # person drift over varied backgrounds; the even-numbered crops are the
+    # gallery, so accuracy is measured on faces the model was not trained on
+    rng = np.random.default_rng(seed)
+    gallery = []
+    gallery_labels = []
+    probes = []
+    names = {}
+    for label, person in enumerate(BENCH_PEOPLE):
+        person_dir = os.path.join(DATA_DIR, person)
+        if not os.path.isdir(person_dir):
+            continue
+        names[label] = person
+        files = sorted(f for f in os.listdir(person_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+        for i, filename in enumerate(files):
+            img = cv2.imread(os.path.join(person_dir, filename), cv2.IMREAD_GRAYSCALE)
+            if img is None:
+                continue
+            if i % 2 == 0:
+                gallery.append(cv2.resize(img, FACE_SIZE))
+                gallery_labels.append(label)
+            else:
+                probes.append((person, img))
+
+    width, height = BENCH_FRAME_SIZE
+    frames = []
+    truth = []
+    segment = 0
+    while probes and len(frames) < BENCH_FRAMES:
+        background = bench_background(rng, segment % 4)
+        count = int(rng.integers(1, min(BENCH_MAX_FACES, len(probes)) + 1))
+        slot_width = width // count
+        actors = []
+        for slot, pick in enumerate(rng.choice(len(probes), size=count, replace=False)):
+            person, img = probes[pick]
+            # One face per vertical strip, so faces never overlap
+            side = int(rng.integers(*BENCH_FACE_SIDE))
+            side = min(side, slot_width - 2, height - 2)
+            face = cv2.cvtColor(cv2.resize(img, (side, side), interpolation=cv2.INTER_AREA), cv2.COLOR_GRAY2BGR)
+            x = int(rng.integers(slot * slot_width, (slot + 1) * slot_width - side))
+            y = int(rng.integers(0, height - side))
+            velocity = rng.uniform(-2, 2, size=2)
+            actors.append((person, face, x, y, velocity, slot * slot_width, (slot + 1) * slot_width - side))
+        for t in range(min(BENCH_SEGMENT_FRAMES, BENCH_FRAMES - len(frames))):
+            frame = background.copy()
+            faces = []
+            for person, face, x, y, velocity, x_min, x_max in actors:
+                side = face.shape[0]
+                fx = int(np.clip(x + velocity[0] * t, x_min, x_max))
+                fy = int(np.clip(y + velocity[1] * t, 0, height - side))
+                frame[fy:fy + side, fx:fx + side] = face
+                faces.append((person, (fx, fy, side, side)))
+            frames.append(frame)
+            truth.append(faces)
+        segment += 1
+    return frames, truth, gallery, np.array(gallery_labels, dtype=np.int32), names
+
+def score_bench_fixture(frames, truth):
+    # A truth face counts as detected when a detection's centre falls inside it
+    faces = detected = correct = unknown = false_positives = 0
+    for frame, expected in zip(frames, truth):
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        boxes = detect_faces(gray)
+        matched = set()
+        for person, (tx, ty, tw, th) in expected:
+            faces += 1
+            hit = next(
+                (
+                    i for i, (x, y, w, h) in enumerate(boxes)
+                    if i not in matched and tx <= x + w / 2 <= tx + tw and ty <= y + h / 2 <= ty + th
+                ),
+                None,
+            )
+            if hit is None:
+                continue
+            matched.add(hit)
+            detected += 1
+            name, _confidence = recognize_face(gray, boxes[hit])
+            correct += name == person
+            unknown += name == "Unknown"
+        false_positives += len(boxes) - len(matched)
+    return {
+        "faces": faces,
+        "detection_recall": round(detected / faces, 4) if faces else 0.0,
+        "accuracy": round(correct / faces, 4) if faces else 0.0,
+        "unknown_rate": round(unknown / faces, 4) if faces else 0.0,
+        "false_accept_rate": round((detected - correct - unknown) / faces, 4) if faces else 0.0,
+        "false_positive_boxes": false_positives,
+    }
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    scale = 1.0 if sys.platform == "darwin" else 1024.0
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / (1024.0 * 1024.0), 1)
+
+def compare_bench_results(old, new):
+    # Accuracy is deterministic and may not drop at all; timings and memory get some slack
+    regressions = []
+    if old.get("fixture") != new["fixture"]:
+        print("Baseline was recorded on a different fixture; only timings are compared.")
+    else:
+        for key in ("detection_recall", "accuracy"):
+            before, after = old["accuracy"][key], new["accuracy"][key]
+            print(f"{key:<28}{before:>10.4f}{after:>10.4f}")
+            if after < before:
+                regressions.append(f"{key} dropped from {before} to {after}")
+    for mode, run in new["runs"].items():
+        previous = old.get("runs", {}).get(mode)
+        if previous is None:
+            continue
+        before, after = previous["fps"], run["fps"]
+        print(f"{mode + ' fps':<28}{before:>10.1f}{after:>10.1f}{(after - before) / before:>+10.1%}")
+        if after < before * (1 - BENCH_FPS_TOLERANCE):
+            regressions.append(f"{mode} fps dropped from {before} to {after}")
+    before, after = old.get("peak_rss_mb"), new["peak_rss_mb"]
+    if before and after:
+        print(f"{'peak RSS MB':<28}{before:>10.1f}{after:>10.1f}{(after - before) / before:>+10.1%}")
+        if after > before * (1 + BENCH_RSS_TOLERANCE):
+            regressions.append(f"peak RSS grew from {before} MB to {after} MB")
+    return regressions
+
+def run_bench_suite(out_path, baseline_path=None):
+    # Camera-free regression benchmark: replays the synthetic fixture through
+    # FaceEngine in each BENCH_MODES configuration and writes a JSON baseline.
+    # Returns the process exit code (1 when the baseline comparison regressed).
+    global active_model, metrics
+    frames, truth, gallery, gallery_labels, names = build_bench_fixture()
+    if not frames:
+        print(f"No samples for {', '.join(BENCH_PEOPLE)} in {DATA_DIR}")
+        return 1
+    recognizer = cv2.face.LBPHFaceRecognizer_create()
+    recognizer.train(gallery, gallery_labels)
+    saved_model = active_model
+    active_model = (recognizer, names)
+
+    try:
+        results = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "environment": {
+                "python": sys.version.split()[0],
+                "opencv": cv2.__version__,
+                "numpy": np.__version__,
+                "cpus": os.cpu_count(),
+                "platform": sys.platform,
+            },
+            "fixture": {
+                "seed": BENCH_SEED,
+                "people": list(names.values()),
+                "frames": len(frames),
+                "frame_size": list(BENCH_FRAME_SIZE),
+                "faces": sum(len(faces) for faces in truth),
+                "gallery": len(gallery),
+                "threshold": CONFIDENCE_THRESHOLD,
+            },
+            "accuracy": score_bench_fixture(frames, truth),
+            "runs": {},
+        }
+
+        # Warm-up so thread pools, the cascade and the batch model are built before timing
+        FaceEngine(batch=True).run(ReplaySource(frames[:BENCH_WARMUP_FRAMES]), headless=True)
+
+        print(f"{'mode':<10}{'fps':>8}{'p50 ms':>9}{'p95 ms':>9}{'detect p95':>12}{'predict p95':>13}")
+        for mode, tracked, batch in BENCH_MODES:
+            metrics = StageMetrics()
+            tracker = FaceTracker() if tracked else None
+            summary = FaceEngine(FaceDetector(), tracker, batch).run(ReplaySource(frames), headless=True)
+            stages = {
+                stage: {key: values[key] for key in ("p50_ms", "p95_ms", "p99_ms", "count")}
+                for stage, values in metrics.snapshot()["stages"].items()
+            }
+            results["runs"][mode] = {
+                "fps": round(summary["fps"], 2),
+                "avg_latency_ms": round(summary["avg_latency_ms"], 2),
+                "dropped": summary["dropped"],
+                "cascade_runs": summary["detections"],
+                "predictions": summary["predictions"],
+                "stages": stages,
+            }
+            latency = stages.get("latency", {})
+            print(
+                f"{mode:<10}{summary['fps']:>8.1f}{latency.get('p50_ms', 0):>9.1f}{latency.get('p95_ms', 0):>9.1f}"
+                f"{stages.get('detect', {}).get('p95_ms', 0):>12.1f}{stages.get('predict', {}).get('p95_ms', 0):>13.1f}"
+            )
+        results["peak_rss_mb"] = peak_rss_mb()
+    finally:
+        metrics = None
+        active_model = saved_model
+
+    accuracy = results["accuracy"]
+    print(
+        f"Accuracy at threshold {CONFIDENCE_THRESHOLD}: {accuracy['accuracy']:.1%} of {accuracy['faces']} faces "
+        f"(detected {accuracy['detection_recall']:.1%}, unknown {accuracy['unknown_rate']:.1%}, "
+        f"false accepts {accuracy['false_accept_rate']:.1%})"
     )
+    print(f"Peak RSS: {results['peak_rss_mb']} MB")
 
-    cv2.imshow("Live Camera", frame)
+    exit_code = 0
+    if baseline_path:
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print()
+        print(f"Compared with {baseline_path}:")
+        regressions = compare_bench_results(baseline, results)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        exit_code = 1 if regressions else 0
 
-    # Press 'q' to quit the window.
-    key = cv2.waitKey(1) & 0xFF
+    save_json(out_path, results)
+    print(f"Benchmark results written to {out_path}")
+    return exit_code
 
-    if key == ord("q"):
-        break
+def calibration_fold_scores(train_hist, train_labels, train_rank, test_hist, test_labels, sizes):
+    # Runs in a worker process. LBPH predict() is a 1-nearest-neighbour search,
+    # so for each test face and gallery size (training samples kept per person)
+    # this keeps the distance to the nearest sample of its own person (genuine)
+    # and of anybody else (impostor: what a model without that person returns)
+    columns = np.ascontiguousarray(train_hist.T)
+    totals = train_hist.sum(axis=1, dtype=np.float64)
+    dist = np.maximum(np.stack([chi_square(query, np.flatnonzero(query), columns, totals) for query in test_hist]), 0.0)
+    own = test_labels[:, None] == train_labels[None, :]
+    scores = {}
+    for size in sizes:
+        kept = train_rank < size
+        genuine = np.where(own & kept, dist, np.inf).min(axis=1)
+        others = np.where(~own & kept, dist, np.inf)
+        nearest = others.argmin(axis=1)
+        scores[size] = (genuine, others[np.arange(len(test_hist)), nearest], train_labels[nearest])
+    return test_labels, scores
 
-    # Retrain request from GUI
-    if retrain_requested:
-        print("Retraining recogniser...")
-        train_images, train_labels, labels_map = load_training_data(DATA_DIR)
-        if len(train_images) == 0:
-            print("No training data found; retrain skipped.")
-        else:
-            recognizer.train(train_images, train_labels)
-            recognizer.save(MODEL_PATH)
-            with open(LABELS_PATH, "w", encoding="utf-8") as f:
-                json.dump(labels_map, f)
-            print("Retrain complete.")
-        retrain_requested = False
-
-    # Apply name from GUI
-    if set_name_requested:
-        current_name = ui_name
-        person_dir = os.path.join(DATA_DIR, current_name)
-        os.makedirs(person_dir, exist_ok=True)
-        saved_count = 0
-        set_name_requested = False
-        print(f"Now capturing samples for {current_name}")
-
-    # Capturing samples
-    if capture_enabled and current_name and len(faces) > 0:
-        now = time.time()
-        if now - last_save_time >= CAPTURE_DELAY_SEC:
-            # Save the biggest detected face
-            (x, y, w, h) = max(faces, key=lambda f: f[2] * f[3])
-            face_crop = frame[y:y + h, x:x + w]
+def false_accept_rates(impostor, thresholds):
+    # Share of unenrolled faces accepted as somebody, per threshold
+    return np.searchsorted(np.sort(impostor), thresholds, side="right") / len(impostor)
 
-            filename = f"{saved_count:03d}.jpg"
-            filepath = os.path.join(DATA_DIR, current_name, filename)
-            cv2.imwrite(filepath, face_crop)
+def calibration_rates(genuine, impostor, thresholds):
+    # FRR: enrolled faces not accepted as themselves; FAR: unenrolled faces
+    # accepted as somebody; MIS: enrolled faces accepted as somebody else
+    correct = genuine <= impostor
+    frr = np.array([1.0 - np.mean(correct & (genuine <= t)) for t in thresholds])
+    mis = np.array([np.mean(~correct & (impostor <= t)) for t in thresholds])
+    return false_accept_rates(impostor, thresholds), frr, mis
 
-            saved_count += 1
-            last_save_time = now
-            print(f"Saved {filepath}")
+def pick_threshold(far, thresholds, target_far):
+    # The most lenient threshold that keeps the false-accept rate on target
+    allowed = np.flatnonzero(far <= target_far)
+    return float(thresholds[allowed[-1]]) if len(allowed) else float(thresholds[0])
+
+def calibrate_thresholds(folds=CALIBRATION_FOLDS, target_far=CALIBRATION_TARGET_FAR):
+    labels_map = assign_label_ids(DATA_DIR, load_labels_map())
+    faces, labels, _loaded = read_samples(DATA_DIR, scan_samples(DATA_DIR, labels_map))
+    people = np.unique(labels)
+    if len(people) < 2:
+        print("Calibration needs samples of at least two people.")
+        return
+    smallest = min(int(np.sum(labels == label)) for label in people)
+    if smallest < folds:
+        print(f"Every person needs at least {folds} samples for {folds}-fold calibration.")
+        return
+
+    histograms = lbp_histograms(np.stack(faces))
+    # Stratified folds: the i-th sample of each person goes to fold i % folds.
+    # rank orders each person's training samples so smaller galleries keep the first ones.
+    fold = np.empty(len(labels), dtype=np.int32)
+    rank = np.empty(len(labels), dtype=np.int32)
+    for label in people:
+        members = np.flatnonzero(labels == label)
+        fold[members] = np.arange(len(members)) % folds
+        rank[members] = np.arange(len(members)) // folds
+    full = smallest - (smallest + folds - 1) // folds
+    sizes = [size for size in CALIBRATION_GALLERY_SIZES if size < full] + [len(labels)]
 
-            if saved_count >= SAMPLES_PER_PERSON:
-                print(f"Done capturing samples for {current_name}")
-                current_name = None
+    jobs = []
+    for k in range(folds):
+        train, test = fold != k, fold == k
+        # Re-rank within the training split (the held-out fold leaves a gap)
+        train_rank = np.empty(int(train.sum()), dtype=np.int32)
+        for label in people:
+            members = labels[train] == label
+            train_rank[members] = np.arange(int(members.sum()))
+        jobs.append((histograms[train], labels[train], train_rank, histograms[test], labels[test], sizes))
+
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=min(folds, os.cpu_count() or 1)) as pool:
+        results = list(pool.map(calibration_fold_scores, *zip(*jobs)))
+    print(
+        f"{folds}-fold calibration over {len(labels)} samples of {len(people)} people "
+        f"({time.perf_counter() - started:.2f}s)"
+    )
+
+    thresholds = np.arange(0, CALIBRATION_MAX_THRESHOLD + 1, dtype=np.float64)
+    current = min(CONFIDENCE_THRESHOLD, CALIBRATION_MAX_THRESHOLD)
+    print(
+        f"{'gallery':>9}{'threshold':>11}{'FAR':>8}{'FRR':>8}{'MIS':>8}{'EER':>8}{'at':>6}"
+        f"{f'FAR@{current}':>9}{f'FRR@{current}':>9}"
+    )
+    report = {}
+    for size in sizes:
+        genuine = np.concatenate([result[1][size][0] for result in results])
+        impostor = np.concatenate([result[1][size][1] for result in results])
+        impostor_labels = np.concatenate([result[1][size][2] for result in results])
+        far, frr, mis = calibration_rates(genuine, impostor, thresholds)
+        chosen = pick_threshold(far, thresholds, target_far)
+        i = int(chosen)
+        eer = int(np.argmin(np.abs(far - frr)))
+        label = "all" if size == len(labels) else f"{size}/person"
+        print(
+            f"{label:>9}{chosen:>11.0f}{far[i]:>8.1%}{frr[i]:>8.1%}{mis[i]:>8.1%}"
+            f"{(far[eer] + frr[eer]) / 2:>8.1%}{thresholds[eer]:>6.0f}{far[current]:>9.1%}{frr[current]:>9.1%}"
+        )
+
+        # Per person: only impostors that land on that person can be falsely accepted as them
+        per_person = {}
+        for person_label in people:
+            name = labels_map[int(person_label)]
+            landing = impostor[impostor_labels == person_label]
+            if len(landing):
+                per_person[name] = pick_threshold(false_accept_rates(landing, thresholds), thresholds, target_far)
+            else:
+                per_person[name] = chosen
+        report[label] = {
+            "threshold": chosen,
+            "people": per_person,
+            "roc": [
+                {"threshold": float(t), "far": round(float(a), 4), "frr": round(float(r), 4), "mis": round(float(m), 4)}
+                for t, a, r, m in zip(thresholds, far, frr, mis)
+            ],
+        }
+
+    best = report["all"]
+    print("Per-person thresholds (full gallery):")
+    for name, threshold in best["people"].items():
+        print(f"  {name:<20}{threshold:>6.0f}")
+    save_json(THRESHOLDS_PATH, {
+        "default": best["threshold"],
+        "people": best["people"],
+        "folds": folds,
+        "target_far": target_far,
+        "samples": len(labels),
+        "galleries": report,
+    })
+    print(f"Thresholds written to {THRESHOLDS_PATH}; the live loop uses them from the next start.")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Live face detection and recognition")
+    parser.add_argument(
+        "--source", nargs="+", default=["0"],
+        help="camera index, stream URL, video file or directory of frames (default: camera 0); "
+        "several sources run side by side with one shared recogniser",
+    )
+    parser.add_argument(
+        "--headless", action="store_true",
+        help="no windows; process the source and print frames/sec at the end",
+    )
+    parser.add_argument("--max-frames", type=int, default=0, help="stop after this many frames")
+    parser.add_argument(
+        "--workers", type=int, default=RECOGNITION_WORKERS,
+        help="recognition worker threads",
+    )
+    parser.add_argument(
+        "--tracker", action="store_true",
+        help="run the cascade every N frames and track faces in between",
+    )
+    parser.add_argument(
+        "--detect-every", type=int, default=DETECT_EVERY_N,
+        help="frames between full detections in tracker mode",
+    )
+    parser.add_argument(
+        "--detect-scale", type=float, default=DETECT_SCALE,
+        help="run the cascade on a copy of the frame resized by this factor (e.g. 0.5)",
+    )
+    parser.add_argument(
+        "--roi", action="store_true",
+        help="only search around the previous frame's faces, with a periodic full-frame pass",
+    )
+    parser.add_argument(
+        "--roi-refresh", type=int, default=ROI_REFRESH_FRAMES,
+        help="frames between full-frame passes in ROI mode",
+    )
+    parser.add_argument(
+        "--compare-modes", action="store_true",
+        help="print an accuracy/throughput report for the detection modes on data/ and --source",
+    )
+    parser.add_argument(
+        "--batch-recognition", action="store_true",
+        help="recognise all faces of a frame in one vectorised LBPH call",
+    )
+    parser.add_argument(
+        "--metrics", action="store_true",
+        help="time every pipeline stage and show p50/p95/p99 and FPS on screen",
+    )
+    parser.add_argument(
+        "--metrics-log", metavar="PATH",
+        help=f"append a JSON metrics snapshot to PATH every {METRICS_LOG_INTERVAL_SEC:g}s (implies --metrics)",
+    )
+    parser.add_argument(
+        "--metrics-port", type=int,
+        help="serve Prometheus-style metrics on 127.0.0.1:PORT/metrics (implies --metrics)",
+    )
+    parser.add_argument(
+        "--jsonl", metavar="PATH",
+        help="offline mode: process --source (video file or image folder) on a process pool "
+             "and write one JSON line per frame to PATH ('-' for stdout)",
+    )
+    parser.add_argument(
+        "--procs", type=int, default=os.cpu_count() or 1,
+        help="worker processes for --jsonl",
+    )
+    parser.add_argument(
+        "--gallery-index", choices=sorted(GALLERY_INDEXES), default=GALLERY_INDEX,
+        help="nearest-neighbour search used by batch recognition",
+    )
+    parser.add_argument(
+        "--equalize-faces", action="store_true",
+        help="histogram-equalise new samples and live face crops (best with a freshly captured data/)",
+    )
+    parser.add_argument(
+        "--bench-index", action="store_true",
+        help="recall/latency of the gallery indexes on synthetic galleries built from data/",
+    )
+    parser.add_argument(
+        "--bench-batch", action="store_true",
+        help="compare batch recognition with the per-face predict loop at 1, 5 and 20 faces",
+    )
+    parser.add_argument(
+        "--calibrate", action="store_true",
+        help="k-fold FAR/FRR evaluation over data/; writes per-person thresholds to thresholds.json",
+    )
+    parser.add_argument(
+        "--folds", type=int, default=CALIBRATION_FOLDS,
+        help="folds for --calibrate",
+    )
+    parser.add_argument(
+        "--target-far", type=float, default=CALIBRATION_TARGET_FAR,
+        help="false-accept rate the --calibrate thresholds are chosen for",
+    )
+    parser.add_argument(
+        "--bench-suite", metavar="OUT_JSON",
+        help="replay a synthetic clip built from data/ and write fps, stage latency, peak RSS and accuracy to OUT_JSON",
+    )
+    parser.add_argument(
+        "--bench-baseline", metavar="JSON",
+        help="with --bench-suite: compare against an earlier result and exit 1 on a regression",
+    )
+    return parser.parse_args()
+
+def main():
+    global active_model, gallery_index, metrics, equalize_faces, calibrated_thresholds
+    args = parse_args()
+    gallery_index = args.gallery_index
+    equalize_faces = args.equalize_faces
+
+    if args.bench_suite:
+        sys.exit(run_bench_suite(args.bench_suite, args.bench_baseline))
+
+    if args.bench_index:
+        benchmark_gallery_index()
+        return
+
+    if args.calibrate:
+        calibrate_thresholds(args.folds, args.target_far)
+        return
+
+    if args.compare_modes:
+        active_model = load_or_train_model(headless=True)
+        clip_path = None if args.source[0].isdigit() else args.source[0]
+        compare_detection_modes(clip_path, args.detect_scale if args.detect_scale != 1.0 else 0.5)
+        return
+
+    if args.bench_batch:
+        active_model = load_or_train_model(headless=True)
+        benchmark_batch_recognition()
+        return
+
+    sources = []
+    for name in args.source:
+        source = FrameSource(name)
+        if not source.is_opened():
+            raise RuntimeError(f"Could not open the source {name!r}.")
+        sources.append(source)
+
+    # The benchmarks above always score at CONFIDENCE_THRESHOLD
+    calibrated_thresholds = load_thresholds()
+    if calibrated_thresholds is not None:
+        print(f"Using calibrated thresholds from {THRESHOLDS_PATH}.", file=sys.stderr if args.jsonl == "-" else sys.stdout)
+
+    if args.jsonl:
+        if len(sources) > 1:
+            raise RuntimeError("--jsonl processes one source at a time.")
+        # Train (if needed) before the workers start; they only read the saved model
+        with redirect_stdout(sys.stderr if args.jsonl == "-" else sys.stdout):
+            load_or_train_model(headless=True)
+        try:
+            run_offline(sources[0], args.jsonl, args.procs, args.detect_scale, args.batch_recognition)
+        finally:
+            sources[0].release()
+        return
+
+    os.makedirs(DATA_DIR, exist_ok=True)
+    active_model = load_or_train_model(headless=args.headless)
+
+    # Detectors and trackers keep per-stream state, so every source gets its own.
+    # Samples are only captured from the first source.
+    sample_writer = None if args.headless else SampleWriter()
+    engines = [
+        FaceEngine(
+            FaceDetector(args.detect_scale, args.roi, args.roi_refresh),
+            FaceTracker(args.detect_every) if args.tracker else None,
+            args.batch_recognition,
+            args.workers,
+            sample_writer if i == 0 else None,
+            name=None if len(sources) == 1 else f"source{i}",
+        )
+        for i in range(len(sources))
+    ]
+    engine = engines[0]
+
+    if not args.headless:
+        print("Controls:")
+        print("  Use the GUI window to set name and start/stop capture")
+        print("  q = quit (camera window)")
+        threading.Thread(target=gui_thread, args=(engine,), daemon=True).start()
+
+    metrics_stop = threading.Event()
+    if args.metrics or args.metrics_log or args.metrics_port is not None:
+        metrics = StageMetrics()
+        if args.metrics_log:
+            start_metrics_log(args.metrics_log, metrics_stop)
+        if args.metrics_port is not None:
+            start_metrics_server(args.metrics_port)
+
+    try:
+        if len(sources) == 1:
+            summaries = [engine.run(sources[0], headless=args.headless, max_frames=args.max_frames)]
+        else:
+            for source_engine, name in zip(engines, args.source):
+                print(f"{source_engine.name}: {name}")
+            summaries = run_sources(engines, sources, args.headless, args.max_frames, args.workers)
+        for summary in summaries:
+            if summary is not None:
+                print_run_summary(summary)
+        if metrics is not None:
+            for line in metrics.overlay_lines():
+                print(line)
+    finally:
+        metrics_stop.set()
+        for source in sources:
+            source.release()
+        if sample_writer is not None:
+            sample_writer.close()
+        if not args.headless:
+            cv2.destroyAllWindows()
 
-cap.release()
-cv2.destroyAllWindows()
+if __name__ == "__main__":
+    main()